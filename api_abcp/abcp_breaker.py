@@ -0,0 +1,82 @@
+import time
+
+from loguru import logger
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен, так как ABCP недоступен и автомат разомкнут"""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты запросов к API ABCP.
+    После failure_threshold ошибок подряд автомат размыкается и запросы сразу завершаются CircuitOpenError.
+    Через reset_timeout секунд пропускается один пробный запрос: при успехе автомат замыкается,
+    при ошибке снова размыкается на reset_timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        """
+        :param failure_threshold: Количество ошибок подряд для размыкания
+        :param reset_timeout: Время до пробного запроса, сек
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe = False
+
+    async def call(self, request, *args, **kwargs):
+        """
+        Выполняем запрос через автомат
+        :param request: Асинхронная функция запроса
+        :return: Результат запроса
+        :raise CircuitOpenError: если автомат разомкнут
+        """
+        probe = self._before_call()
+        try:
+            result = await request(*args, **kwargs)
+        except Exception:
+            self._on_failure()
+            raise
+        finally:
+            if probe:
+                self._probe = False
+        self._on_success()
+        return result
+
+    def _before_call(self) -> bool:
+        """
+        Проверяем, можно ли отправить запрос
+        :return: True, если запрос пробный
+        """
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            logger.info("Отправляем пробный запрос к ABCP")
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probe):
+            raise CircuitOpenError("ABCP недоступен, запрос не отправлен")
+        if self.state == self.HALF_OPEN:
+            self._probe = True
+        return self._probe
+
+    def _on_success(self) -> None:
+        # Успешный ответ на запрос, отправленный до размыкания, автомат не замыкает
+        if self.state == self.OPEN:
+            return
+        if self.state == self.HALF_OPEN:
+            logger.info("ABCP снова отвечает, возобновляем запросы")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def _on_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error(f"ABCP не отвечает ({self.failures} ошибок подряд), "
+                             f"приостанавливаем запросы на {self.reset_timeout:.0f} сек")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
@@ -0,0 +1,65 @@
+import asyncio
+import contextlib
+
+from collections import Counter, deque
+
+
+class FairShare:
+    """
+    Общий лимит одновременных запросов к ABCP для нескольких магазинов.
+    Освободившееся место отдаётся по кругу следующему магазину с ожидающими запросами,
+    поэтому большой каталог одного магазина не задерживает проценку остальных.
+    """
+    def __init__(self, limit: int = 64):
+        """
+        :param limit: Общий лимит одновременных запросов
+        """
+        self.limit = limit
+        self.in_flight = 0
+        self.granted = Counter()
+        self._queues = {}
+        self._turns = deque()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, name: str):
+        """
+        Место для одного запроса магазина
+        :param name: Имя магазина
+        """
+        await self._acquire(name)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, name: str) -> None:
+        """Ожидаем место. Запросы одного магазина обслуживаются по очереди, магазины - по кругу"""
+        if self.in_flight < self.limit and not self._turns:
+            self.in_flight += 1
+            self.granted[name] += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(name, deque())
+        if not queue:
+            self._turns.append(name)
+        queue.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        """Освобождаем место и передаём свободные места магазинам по кругу"""
+        self.in_flight -= 1
+        while self._turns and self.in_flight < self.limit:
+            name = self._turns.popleft()
+            queue = self._queues[name]
+            waiter = queue.popleft()
+            if queue:
+                self._turns.append(name)
+            if not waiter.done():
+                self.in_flight += 1
+                self.granted[name] += 1
+                waiter.set_result(None)
@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+from collections import deque
+
+from loguru import logger
+
+
+class AdaptiveLimiter:
+    """
+    Адаптивное ограничение количества одновременных запросов к API ABCP.
+    Пока 95-й перцентиль времени ответа и доля ошибок в окне запросов не превышают целевых значений,
+    лимит увеличивается на increase_step. При ошибке, таймауте или росте времени ответа
+    лимит уменьшается в decrease_factor раз. Запросы, отправленные до последнего изменения лимита,
+    в оценку нового окна не попадают.
+    """
+    def __init__(self, start_limit: int = 4, min_limit: int = 1, max_limit: int = 32,
+                 target_latency: float = 3.0, max_error_rate: float = 0.05, window_size: int = 20,
+                 increase_step: float = 1.0, decrease_factor: float = 0.5):
+        """
+        :param start_limit: Начальный лимит одновременных запросов
+        :param min_limit: Минимальный лимит
+        :param max_limit: Максимальный лимит
+        :param target_latency: Целевой 95-й перцентиль времени ответа, сек
+        :param max_error_rate: Допустимая доля ошибок в окне запросов
+        :param window_size: Количество запросов, по которому оценивается время ответа
+        :param increase_step: Шаг увеличения лимита
+        :param decrease_factor: Коэффициент уменьшения лимита
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window_size = window_size
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self.limit = float(start_limit)
+        self.in_flight = 0
+        self.history = [(time.time(), int(self.limit), 'start')]
+        self._latencies = []
+        self._errors = 0
+        self._window_start = 0.0
+        self._recent = deque(maxlen=100)
+        self._waiters = deque()
+
+    async def run(self, request, *args, **kwargs):
+        """
+        Выполняем запрос с учётом текущего лимита и учитываем его время ответа и результат
+        :param request: Асинхронная функция запроса
+        :return: Результат запроса. Исключения запроса пробрасываются дальше
+        """
+        await self._acquire()
+        start = time.monotonic()
+        try:
+            result = await request(*args, **kwargs)
+        except asyncio.CancelledError:
+            # Отменённый запрос (например, проигравший дублирующий запрос) не учитываем в оценке
+            self._release_slot()
+            raise
+        except Exception:
+            self._release(start, False)
+            raise
+        self._release(start, True)
+        return result
+
+    async def _acquire(self) -> None:
+        """Ожидаем свободное место в пределах текущего лимита. Ожидающие запросы обслуживаются по очереди"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            raise
+
+    def _release(self, start: float, success: bool) -> None:
+        """Освобождаем место запроса и пересчитываем лимит"""
+        self._recent.append(time.monotonic() - start)
+        if start >= self._window_start:
+            self._latencies.append(time.monotonic() - start)
+            if not success:
+                self._errors += 1
+                self._decrease('error')
+            elif len(self._latencies) >= self.window_size:
+                self._adjust()
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        """Освобождаем место и передаём свободные места ожидающим запросам"""
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _adjust(self) -> None:
+        """Оцениваем окно запросов и увеличиваем или уменьшаем лимит"""
+        p95 = self.p95()
+        error_rate = self._errors / len(self._latencies)
+        if p95 > self.target_latency:
+            self._decrease(f'latency {p95:.2f}s')
+        elif error_rate > self.max_error_rate:
+            self._decrease(f'errors {error_rate:.0%}')
+        else:
+            self._set_limit(min(self.max_limit, self.limit + self.increase_step), f'p95 {p95:.2f}s')
+
+    def _decrease(self, reason: str) -> None:
+        """Уменьшаем лимит в decrease_factor раз и начинаем новое окно"""
+        self._set_limit(max(self.min_limit, self.limit * self.decrease_factor), reason)
+
+    def _set_limit(self, limit: float, reason: str) -> None:
+        """Устанавливаем лимит, записываем изменение в историю и начинаем новое окно запросов"""
+        if int(limit) != int(self.limit):
+            logger.debug(f"Лимит одновременных запросов к ABCP: {int(self.limit)} -> {int(limit)} ({reason})")
+            self.history.append((time.time(), int(limit), reason))
+        self.limit = limit
+        self._latencies = []
+        self._errors = 0
+        self._window_start = time.monotonic()
+
+    def p95(self) -> float:
+        """95-й перцентиль времени ответа в текущем окне запросов, сек"""
+        if not self._latencies:
+            return 0.0
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def recent_p95(self, min_count: int = 10) -> float or None:
+        """
+        95-й перцентиль времени ответа по последним 100 запросам независимо от окон лимита, сек
+        :param min_count: Минимальное количество запросов для оценки
+        :return: float or None, если запросов меньше min_count
+        """
+        if len(self._recent) < min_count:
+            return None
+        latencies = sorted(self._recent)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def stats(self) -> dict:
+        """
+        Текущее состояние для метрик
+        :return: {
+            'limit' - текущий лимит,
+            'in_flight' - количество выполняемых запросов,
+            'p95' - 95-й перцентиль времени ответа в текущем окне,
+            'history' - история изменения лимита [(время, лимит, причина), ...]
+            }
+        """
+        return {'limit': int(self.limit), 'in_flight': self.in_flight, 'p95': self.p95(), 'history': self.history}
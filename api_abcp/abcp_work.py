@@ -1,18 +1,72 @@
 # from telegram.send_teleg import *
 import datetime
 import asyncio
+import contextlib
+import json
+import re
 import time
 
 from aioabcpapi import Abcp
+from aioabcpapi.exceptions import AbcpNotFoundError
 # from data_notif.csv_work import WorkCSV
 from loguru import logger
 from config import AUTH_API
+from api_abcp.abcp_limiter import AdaptiveLimiter
+from api_abcp.abcp_breaker import CircuitBreaker
 # from google_table.google_tb_work import WorkGoogle
 
+# Максимальное время ответа ABCP на один запрос, сек
+REQUEST_TIMEOUT: float = 30.0
+# Отправлять дублирующий запрос, если ответ не получен за 95-й перцентиль времени ответа
+HEDGE_REQUESTS: bool = True
+
+# Количество заказов на странице, количество одновременно запрашиваемых страниц и повторов при ошибке
+ORDERS_PAGE_SIZE: int = 500
+ORDERS_PAGE_CONCURRENCY: int = 4
+ORDERS_PAGE_RETRIES: int = 2
+# Файл с датой последнего изменения заказов, полученных при прошлой синхронизации
+ORDERS_SYNC_FILE: str = 'orders_sync.json'
+
+# Максимальное количество позиций в одном заказе поставщику (ограничение ABCP для сторонних поставщиков)
+ORDER_BATCH_SIZE: int = 20
+# Максимальное количество одновременных запросов на оформление заказов
+ORDER_CONCURRENCY: int = 4
+# Минимальный интервал между запросами на оформление заказов, сек
+ORDER_MIN_INTERVAL: float = 0.5
+# Код ошибки ABCP "Позиция заблокирована на 5 мин.", пауза перед повторной отправкой и количество повторов
+ORDER_LOCKED_CODE: int = 200
+ORDER_LOCK_DELAY: float = 300.0
+ORDER_LOCK_RETRIES: int = 1
+
 
 class WorkABCP:
-    def __init__(self):
-        self.api_abcp = Abcp(AUTH_API['HOST_API'], AUTH_API['USER_API'], AUTH_API['PASSWORD_API'])
+    def __init__(self, auth: dict = None):
+        """
+        :param auth: Параметры подключения с ключами 'HOST_API', 'USER_API', 'PASSWORD_API'. По умолчанию AUTH_API
+        """
+        auth = auth or AUTH_API
+        self.api_abcp = Abcp(auth['HOST_API'], auth['USER_API'], auth['PASSWORD_API'])
+        self.limiter = AdaptiveLimiter()
+        self.breaker = CircuitBreaker()
+        self.timeout = REQUEST_TIMEOUT
+        self.hedge = HEDGE_REQUESTS
+        self._next_order_slot = 0.0
+        # Все ли страницы заказов получены при последнем вызове iter_orders_by_status
+        self.orders_complete = True
+        # Не закрывать сессию после проценки, чтобы повторно использовать соединения (режим службы)
+        self.keep_session = False
+        # Общая очередь запросов нескольких магазинов (FairShare) и имя магазина в ней
+        self.fair_share = None
+        self.tenant = ''
+
+    def use_session(self, session) -> None:
+        """
+        Используем общую сессию aiohttp, например одну на несколько магазинов.
+        Сессия не закрывается после проценки, её закрывает владелец
+        :param session: aiohttp.ClientSession
+        """
+        self.api_abcp._base._session = session
+        self.keep_session = True
 
     async def get_order_by_status(self, status, date_create):
         """
@@ -37,6 +91,110 @@ class WorkABCP:
             logger.info(f"Заказов по указанному статусу {status} нет")
         return orders
 
+    async def iter_orders_by_status(self, status, date_create=None, incremental: bool = True):
+        """
+        Асинхронный генератор заказов с определенным статусом из API ABCP.
+        Заказы запрашиваются страницами по ORDERS_PAGE_SIZE, не более ORDERS_PAGE_CONCURRENCY страниц одновременно,
+        и отдаются по мере получения страниц.
+        При incremental=True запрашиваются только заказы, созданные или изменённые с момента прошлой синхронизации.
+        Дата последнего изменения полученных заказов сохраняется в ORDERS_SYNC_FILE, только если получены
+        все страницы. Если какую-либо страницу получить не удалось, то после обхода self.orders_complete = False,
+        чтобы вызывающий код мог отличить неполный список от отсутствия заказов
+        :param status: Код статуса позиции заказа (один или список кодов)
+        :param date_create: Начальная дата создания заказов для первой синхронизации
+        :param incremental: Использовать дату прошлой синхронизации
+        :return: Словари заказов в порядке получения страниц
+        """
+        sync_key = str(status)
+        mark = self.get_orders_sync_mark(sync_key) if incremental else ''
+        params = {'status_code': status, 'format': 'p', 'limit': ORDERS_PAGE_SIZE}
+        if mark:
+            params['date_updated_start'] = mark
+            logger.info(f"Получаем заказы по статусу {status}, изменённые с {mark}")
+        else:
+            params['date_created_start'] = date_create
+            logger.info(f"Получаем заказы по статусу {status}, созданные с {date_create}")
+
+        semaphore = asyncio.Semaphore(ORDERS_PAGE_CONCURRENCY)
+        tasks = []
+        self.orders_complete = False
+        try:
+            first_page = await self._get_orders_page(params, 0, semaphore)
+            if first_page is None:
+                logger.warning(f"Не удалось получить заказы по статусу {status}, список заказов не получен")
+                return
+            count = int(first_page.get('count') or 0)
+            tasks = [asyncio.ensure_future(self._get_orders_page(params, skip, semaphore))
+                     for skip in range(ORDERS_PAGE_SIZE, count, ORDERS_PAGE_SIZE)]
+
+            new_mark = mark
+            complete = True
+            pages = [asyncio.sleep(0, first_page)] + tasks
+            for page in asyncio.as_completed(pages):
+                page = await page
+                if page is None:
+                    complete = False
+                    continue
+                for order in page.get('items') or []:
+                    new_mark = max(new_mark, str(order.get('dateUpdated') or order.get('date') or ''))
+                    yield order
+
+            logger.info(f"Получили по статусу {status} - {count} заказа(ов)")
+            if not complete:
+                logger.warning(f"Получены не все страницы заказов по статусу {status}, "
+                               f"дата синхронизации не сохранена")
+            elif new_mark:
+                self.set_orders_sync_mark(sync_key, new_mark)
+            self.orders_complete = complete
+        finally:
+            for task in tasks:
+                task.cancel()
+            if not self.keep_session:
+                await self.api_abcp.close()
+
+    async def _get_orders_page(self, params: dict, skip: int, semaphore: asyncio.Semaphore) -> dict or None:
+        """
+        Одна страница списка заказов с повторной попыткой при ошибке
+        :return: {'count': ..., 'items': [...]} или None, если страницу получить не удалось
+        """
+        for attempt in range(ORDERS_PAGE_RETRIES + 1):
+            try:
+                async with semaphore:
+                    return await self.api_abcp.cp.admin.orders.get_orders_list(skip=skip, **params)
+            except Exception as e:
+                logger.error(f"Ошибка при получении страницы заказов (skip={skip}) с платформы ABCP: {e}")
+                await asyncio.sleep(2 ** attempt)
+        return None
+
+    @staticmethod
+    def get_orders_sync_mark(sync_key: str) -> str:
+        """
+        Дата последнего изменения заказов, полученных при прошлой синхронизации
+        :param sync_key: Ключ синхронизации (статусы заказов)
+        :return: Дата в формате '%Y-%m-%d %H:%M:%S' или пустая строка
+        """
+        try:
+            with open(ORDERS_SYNC_FILE, encoding='utf-8') as file:
+                return json.load(file).get(sync_key, '')
+        except (OSError, ValueError):
+            return ''
+
+    @staticmethod
+    def set_orders_sync_mark(sync_key: str, mark: str) -> None:
+        """
+        Сохраняем дату последнего изменения полученных заказов
+        :param sync_key: Ключ синхронизации (статусы заказов)
+        :param mark: Дата в формате '%Y-%m-%d %H:%M:%S'
+        """
+        try:
+            with open(ORDERS_SYNC_FILE, encoding='utf-8') as file:
+                marks = json.load(file)
+        except (OSError, ValueError):
+            marks = {}
+        marks[sync_key] = mark
+        with open(ORDERS_SYNC_FILE, 'w', encoding='utf-8') as file:
+            json.dump(marks, file, ensure_ascii=False)
+
     async def create_order_supplier(self, order_params: dict, positions: list[dict]):
         """
         Оформление заказов поставщику.
@@ -53,32 +211,313 @@ class WorkABCP:
             logger.debug(order_params)
             logger.debug(positions)
 
-            # result = await self.api_abcp.cp.admin.orders.send_online_order(
-            #     order_params=order_params,
-            #     positions=positions
-            # )
-            raise Exception({'errorCode': 200,
-                             'errorMessage': 'Позиция 475180961 заблокирована на 5 мин. '
-                                             'Прежде чем отправлять позицию ещё раз, убедитесь, '
-                                             'что она не попала в заказ поставщику.'})
-
-            # result = []
+            result = await self.api_abcp.cp.admin.orders.send_online_order(
+                order_params=order_params,
+                positions=positions
+            )
         except Exception as ex:
             logger.error(ex)
             result = {'errorMessage': ex}
 
         return result
 
-    async def get_price_supplier(self, brand, number):
-        """"
-        Получаем цены поставщиков по позиции
+    async def send_orders_by_distributor(self, positions: list[dict]) -> list[dict]:
+        """
+        Оформление заказов поставщикам по списку позиций.
+        Позиции группируются по поставщику и параметрам заказа и отправляются пакетами до ORDER_BATCH_SIZE позиций.
+        Разные поставщики обрабатываются одновременно (не более ORDER_CONCURRENCY запросов и не чаще
+        ORDER_MIN_INTERVAL сек), позиции одного поставщика - последовательно, как требует ABCP.
+        Результат каждой позиции берётся из ответа ABCP по этой позиции. Заблокированные позиции (errorCode 200)
+        отправляются повторно через ORDER_LOCK_DELAY сек, если их статус за это время не изменился
+        :param positions: Список позиций [{'id': Идентификатор позиции, 'distributorId': Идентификатор поставщика,
+            'order_params': словарь параметров заказа у поставщика (необязательно),
+            остальные ключи - параметры позиции для заказа у поставщика}, ...]
+        :return: Результат по каждой позиции в том же порядке
+            [{'id': Идентификатор позиции, 'status': 'ok', 'locked' или 'error',
+              'result': ответ ABCP по позиции или 'errorMessage': текст ошибки}, ...]
+        """
+        groups = {}
+        for index, position in enumerate(positions):
+            params = json.dumps(position.get('order_params') or {}, sort_keys=True, ensure_ascii=False)
+            groups.setdefault(str(position['distributorId']), {}).setdefault(params, []).append(index)
+
+        results = [{}] * len(positions)
+        semaphore = asyncio.Semaphore(ORDER_CONCURRENCY)
+
+        async def send_distributor(distributor_groups: dict) -> None:
+            for params, indexes in distributor_groups.items():
+                for start in range(0, len(indexes), ORDER_BATCH_SIZE):
+                    batch = indexes[start:start + ORDER_BATCH_SIZE]
+                    batch_positions = [
+                        {key: value for key, value in positions[i].items() if key not in ('distributorId', 'order_params')}
+                        for i in batch
+                    ]
+                    batch_results = await self._send_order_batch(json.loads(params), batch_positions, semaphore)
+                    for i, result in zip(batch, batch_results):
+                        results[i] = {'id': positions[i]['id'], **result}
+
+        try:
+            await asyncio.gather(*(send_distributor(distributor_groups) for distributor_groups in groups.values()))
+        finally:
+            if not self.keep_session:
+                await self.api_abcp.close()
+
+        logger.info(f"Отправлено в заказ {sum(result['status'] == 'ok' for result in results)} "
+                    f"из {len(results)} позиций по {len(groups)} поставщикам")
+        return results
+
+    async def _send_order_batch(self, order_params: dict, positions: list[dict],
+                                semaphore: asyncio.Semaphore) -> list[dict]:
+        """
+        Отправка одного пакета позиций поставщику с повторной отправкой заблокированных позиций.
+        Перед повторной отправкой проверяем, что статус позиции не изменился за время блокировки,
+        то есть позицию не оформили в заказ из панели управления или другим запросом
+        :return: Результат по каждой позиции пакета в том же порядке
+            [{'status': 'ok', 'result': ответ ABCP по позиции} или {'status': 'locked'/'error', 'errorMessage': текст}]
+        """
+        results = [{}] * len(positions)
+        pending = list(range(len(positions)))
+        for attempt in range(ORDER_LOCK_RETRIES + 1):
+            async with semaphore:
+                # Соблюдаем минимальный интервал между запросами на оформление заказа
+                now = time.monotonic()
+                slot = max(now, self._next_order_slot)
+                self._next_order_slot = slot + ORDER_MIN_INTERVAL
+                await asyncio.sleep(slot - now)
+                response = await self.create_order_supplier(order_params, [positions[i] for i in pending])
+
+            for i, result in zip(pending, self.parse_order_result(response, [positions[i]['id'] for i in pending])):
+                results[i] = result
+            locked = [i for i in pending if results[i]['status'] == 'locked']
+            if not locked or attempt == ORDER_LOCK_RETRIES:
+                break
+
+            logger.warning(f"Позиции {[positions[i]['id'] for i in locked]} заблокированы, "
+                           f"повторная отправка через {ORDER_LOCK_DELAY} сек")
+            statuses = [await self.get_position_status(positions[i]['id']) for i in locked]
+            await asyncio.sleep(ORDER_LOCK_DELAY)
+            pending = []
+            for i, status in zip(locked, statuses):
+                current = await self.get_position_status(positions[i]['id'])
+                if status is None or current is None:
+                    results[i] = {'status': 'locked', 'errorMessage': f"{results[i]['errorMessage']}; "
+                                                                      f"не удалось проверить статус позиции"}
+                elif current != status:
+                    results[i] = {'status': 'locked', 'errorMessage': f"{results[i]['errorMessage']}; "
+                                                                      f"статус позиции изменился, повторно не отправлена"}
+                else:
+                    pending.append(i)
+            if not pending:
+                break
+        return results
+
+    def parse_order_result(self, response, ids: list) -> list[dict]:
+        """
+        Результат по каждой позиции из ответа ABCP на оформление заказа.
+        ABCP возвращает позиции со статусом и кодом ошибки в списке positions (в ответе или в каждом созданном
+        заказе orders). Ошибка запроса целиком относится ко всем позициям. Если в ответе нет списка позиций,
+        то все позиции считаются отправленными
+        :param response: Ответ create_order_supplier
+        :param ids: Идентификаторы отправленных позиций
+        :return: [{'status': 'ok', 'result': ответ по позиции} или {'status': 'locked'/'error', 'errorMessage': текст}]
+        """
+        if isinstance(response, dict) and 'errorMessage' in response and not self.order_positions(response):
+            return [self.position_result(response)] * len(ids)
+
+        answers = self.order_positions(response)
+        if answers is None:
+            return [{'status': 'ok', 'result': response}] * len(ids)
+        by_id = {str(answer.get('id')): answer for answer in answers if isinstance(answer, dict)}
+        return [
+            self.position_result(by_id[str(position_id)]) if str(position_id) in by_id
+            else {'status': 'error', 'errorMessage': 'позиция отсутствует в ответе ABCP'}
+            for position_id in ids
+        ]
+
+    @staticmethod
+    def order_positions(response) -> list[dict] or None:
+        """
+        Список позиций из ответа ABCP на оформление заказа
+        :return: Позиции из positions ответа и всех заказов orders или None, если позиций в ответе нет
+        """
+        if not isinstance(response, dict):
+            return None
+        answers = None
+        if isinstance(response.get('positions'), list):
+            answers = list(response['positions'])
+        orders = response.get('orders')
+        orders = orders.values() if isinstance(orders, dict) else orders if isinstance(orders, list) else []
+        for order in orders:
+            if isinstance(order, dict) and isinstance(order.get('positions'), list):
+                answers = (answers or []) + order['positions']
+        return answers
+
+    def position_result(self, answer: dict) -> dict:
+        """
+        Результат позиции по её ответу ABCP: errorCode 200 - позиция заблокирована,
+        другой код ошибки, текст ошибки или status 0 - ошибка, иначе позиция отправлена
+        """
+        error = answer.get('errorMessage')
+        code = self.get_error_code(answer)
+        if code is None and error is not None:
+            code = self.get_error_code(error)
+        if code == ORDER_LOCKED_CODE:
+            return {'status': 'locked', 'errorMessage': str(error or code)}
+        if code or error or str(answer.get('status')) == '0':
+            return {'status': 'error', 'errorMessage': str(error or code or 'позиция не отправлена')}
+        return {'status': 'ok', 'result': answer}
+
+    async def get_position_status(self, position_id) -> str or None:
+        """
+        Последняя запись истории статусов позиции заказа
+        :return: Запись строкой для сравнения или None, если историю получить не удалось
         """
         try:
-            product = await self.api_abcp.cp.client.search.articles(brand=brand, number=number, use_online_stocks=1)
+            history = await self.api_abcp.cp.admin.orders.status_history(position_id)
         except Exception as ex:
-            logger.error(f"При отправке запроса по продукту произошла ошибка: {ex}. Делаем паузу 30 сек")
-            time.sleep(30)
-            product = []
-        await self.api_abcp.close()
-        return product
+            logger.error(ex)
+            return None
+        last = history[-1] if isinstance(history, list) and history else history
+        return json.dumps(last, sort_keys=True, ensure_ascii=False, default=str)
+
+    @staticmethod
+    def get_error_code(error) -> int or None:
+        """
+        Получаем код ошибки ABCP из исключения.
+        aioabcpapi передаёт ошибку строкой вида 'errorMessage errorCode [HTTP статус]'
+        :param error: Исключение или словарь {'errorCode', 'errorMessage'}
+        :return: Код ошибки или None
+        """
+        if isinstance(error, Exception) and error.args and isinstance(error.args[0], dict):
+            error = error.args[0]
+        if isinstance(error, dict):
+            return int(error['errorCode']) if str(error.get('errorCode', '')).isdigit() else None
+        match = re.search(r'(\d+) \[\d+\]$', str(error))
+        return int(match.group(1)) if match else None
+
+    async def get_prices_supplier(self, searches: list[tuple]) -> list[list[dict]]:
+        """
+        Получаем цены поставщиков по списку позиций одновременными запросами.
+        Количество одновременных запросов регулирует self.limiter по времени ответа и ошибкам ABCP
+        :param searches: Список позиций для поиска [(brand, number), ...]
+        :return: Список предложений по каждой позиции в том же порядке.
+            Если ответ по позиции не получен (таймаут, ошибка, ABCP недоступен) - None
+        """
+        try:
+            products = await asyncio.gather(*(self._search_articles(brand, number) for brand, number in searches))
+        finally:
+            if not self.keep_session:
+                await self.api_abcp.close()
+        logger.info(f"Лимит одновременных запросов к ABCP в конце проценки: {self.limiter.stats()['limit']}, "
+                    f"изменений лимита: {len(self.limiter.history) - 1}")
+        return products
+
+    async def get_prices_supplier_stream(self, searches) -> list[list[dict]]:
+        """
+        Получаем цены поставщиков по позициям, поступающим из асинхронного итератора.
+        Запрос по позиции отправляется сразу после её получения, не дожидаясь остальных
+        :param searches: Асинхронный итератор позиций для поиска (brand, number)
+        :return: Список предложений по каждой позиции в порядке поступления, как у get_prices_supplier
+        """
+        tasks = []
+        try:
+            async for brand, number in searches:
+                tasks.append(asyncio.ensure_future(self._search_articles(brand, number)))
+            products = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            if not self.keep_session:
+                await self.api_abcp.close()
+        logger.info(f"Лимит одновременных запросов к ABCP в конце проценки: {self.limiter.stats()['limit']}, "
+                    f"изменений лимита: {len(self.limiter.history) - 1}")
+        return products
+
+    async def get_brands(self, number) -> list[str] or None:
+        """
+        Бренды ABCP, у которых есть деталь с указанным номером (search/brands)
+        :param number: Номер детали
+        :return: Список брендов или None, если ответ не получен
+        """
+        async def request_brands():
+            try:
+                result = await asyncio.wait_for(self.api_abcp.cp.client.search.brands(number=number), self.timeout)
+            except AbcpNotFoundError:
+                return []
+            items = result.values() if isinstance(result, dict) else result or []
+            return [item['brand'] for item in items if item.get('brand')]
+
+        try:
+            return await self.breaker.call(self.limiter.run, request_brands)
+        except Exception as ex:
+            logger.error(f"Не получили бренды по номеру {number}. Ошибка: {ex!r}")
+            return None
+
+    async def _search_articles(self, brand, number) -> list[dict] or None:
+        """
+        Запрос предложений по одной позиции с учётом лимита одновременных запросов,
+        таймаута, дублирующего запроса и автомата защиты.
+        Если задана общая очередь нескольких магазинов, запрос ждёт в ней своей очереди
+        :return: Список предложений или None, если ответ не получен
+        """
+        try:
+            async with self.fair_share.slot(self.tenant) if self.fair_share else contextlib.nullcontext():
+                if self.hedge:
+                    return await self._hedged_request(brand, number)
+                return await self._request(brand, number)
+        except Exception as ex:
+            logger.error(f"Не получили ответ по продукту {brand}: {number}, повторим при следующем запуске. "
+                         f"Ошибка: {ex!r}")
+            return None
+
+    async def _hedged_request(self, brand, number) -> list[dict]:
+        """
+        Если ответ на запрос не получен за 95-й перцентиль времени ответа,
+        то отправляем дублирующий запрос и берём первый успешный ответ
+        """
+        started = asyncio.Event()
+        tasks = {asyncio.ensure_future(self._request(brand, number, started))}
+        # Время ожидания ответа считаем с момента отправки запроса, а не с постановки в очередь лимита
+        wait_started = asyncio.ensure_future(started.wait())
+        await asyncio.wait(tasks | {wait_started}, return_when=asyncio.FIRST_COMPLETED)
+        wait_started.cancel()
+
+        delay = self.limiter.recent_p95() or self.limiter.target_latency
+        done, pending = await asyncio.wait(tasks, timeout=delay)
+        if not done and self.breaker.state == CircuitBreaker.CLOSED:
+            logger.debug(f"Нет ответа по {brand}: {number} за {delay:.1f} сек, отправляем дублирующий запрос")
+            pending.add(asyncio.ensure_future(self._request(brand, number)))
+
+        error = None
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _request(self, brand, number, started: asyncio.Event = None) -> list[dict]:
+        """Запрос через автомат защиты и лимит одновременных запросов"""
+        return await self.breaker.call(self.limiter.run, self._request_articles, brand, number, started)
+
+    async def _request_articles(self, brand, number, started: asyncio.Event = None) -> list[dict]:
+        """
+        Запрос предложений с ограничением времени ответа.
+        Отсутствие позиции у ABCP считаем успешным ответом без предложений
+        """
+        if started is not None:
+            started.set()
+        try:
+            return await asyncio.wait_for(
+                self.api_abcp.cp.client.search.articles(brand=brand, number=number, use_online_stocks=1),
+                self.timeout
+            )
+        except AbcpNotFoundError:
+            return []
 
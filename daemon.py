@@ -0,0 +1,282 @@
+# Author Loik Andrey mail: loikand@mail.ru
+import argparse
+import asyncio
+import json
+import signal
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+from aiohttp import web
+from loguru import logger
+
+from api_abcp.abcp_work import WorkABCP
+from data_local.history_work import WorkHistory
+from data_local.memo_work import WorkMemo
+from data_local.price_index_work import WorkPriceIndex
+from data_local.storage_work import STORAGES, get_storage
+from main import (add_result_to_all_product, evaluate_products, filtered_products_by_flag, save_error,
+                  search_keys, selected_prices, selected_rule_for_position, sort_price_products)
+
+# Порт HTTP сервера состояния службы (только локальные подключения)
+DAEMON_PORT: int = 8085
+
+# Количество позиций, проценяемых за один цикл
+DAEMON_BATCH: int = 500
+
+# Через сколько секунд после проценки позиция снова может попасть в очередь
+DAEMON_REPRICE_INTERVAL: float = 6 * 3600
+
+# Пауза, если все отмеченные позиции уже проценены, сек
+DAEMON_IDLE_DELAY: float = 60.0
+
+# Как часто перечитываем позиции и проверяем изменение правил, сек
+PRODUCTS_RELOAD_INTERVAL: float = 300.0
+RULES_CHECK_INTERVAL: float = 300.0
+
+# Время жизни предложений ABCP в памяти службы, сек
+OFFER_CACHE_TTL: float = 600.0
+
+
+class WorkDaemon:
+    """
+    Служба непрерывной проценки. В отличие от запуска main.py по расписанию, держит в памяти сессию ABCP,
+    подключение к хранилищу, правила и полученные предложения.
+    Каждый цикл проценивает DAEMON_BATCH отмеченных позиций, начиная с давно проценённых.
+    Все обращения к хранилищу и базам SQLite выполняются в одном отдельном потоке,
+    поэтому HTTP сервер состояния отвечает и во время применения правил
+    """
+    def __init__(self, storage: str = 'google', workers: int = 1, batch: int = DAEMON_BATCH):
+        """
+        :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+        :param workers: Количество процессов для применения правил
+        :param batch: Количество позиций за цикл
+        """
+        self.storage = storage
+        self.workers = workers
+        self.batch = batch
+        self.work_abcp = WorkABCP()
+        self.work_abcp.keep_session = True
+
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='daemon-storage')
+        self._wk_g = None
+        self._memo = None
+        self._history = None
+        self._price_index = None
+
+        self.all_products = []
+        self.rules = []
+        self.own_warehouses = []
+        self._rules_signature = ''
+        self._products_loaded = 0.0
+        self._rules_checked = 0.0
+        self._priced_at = {}
+        self.offer_cache = {}
+
+        self.stopping = asyncio.Event()
+        self.started = time.time()
+        self.progress = {'state': 'starting', 'cycles': 0, 'priced': 0, 'batch': 0, 'queue': 0,
+                         'rules_reloads': 0, 'offer_cache_hits': 0, 'last_cycle': '', 'last_error': ''}
+
+    async def _run(self, func, *args):
+        """Выполняем блокирующую функцию в потоке хранилища"""
+        return await asyncio.get_running_loop().run_in_executor(self._thread, func, *args)
+
+    def _open(self) -> None:
+        """Подключаемся к хранилищу и базам в потоке хранилища"""
+        if self._wk_g is None:
+            self._wk_g = get_storage(self.storage)
+            self._memo = WorkMemo()
+            self._history = WorkHistory()
+            self._price_index = WorkPriceIndex()
+
+    def _reload(self) -> None:
+        """Перечитываем позиции и правила, если с прошлого чтения прошло больше заданного интервала"""
+        self._open()
+        now = time.monotonic()
+        if not self._products_loaded or now - self._products_loaded >= PRODUCTS_RELOAD_INTERVAL:
+            self.all_products = self._wk_g.get_products()
+            self._products_loaded = now
+            logger.info(f"Считали {len(self.all_products)} позиций")
+        if not self._rules_checked or now - self._rules_checked >= RULES_CHECK_INTERVAL:
+            rules, own_warehouses = self._wk_g.get_price_filter_rules()
+            self._rules_checked = now
+            signature = json.dumps([rules, own_warehouses], ensure_ascii=False, sort_keys=True, default=str)
+            if signature != self._rules_signature:
+                self.rules, self.own_warehouses = rules, own_warehouses
+                self._rules_signature = signature
+                self.progress['rules_reloads'] += 1
+                logger.info(f"Правила проценки изменились, загружено {len(rules)} правил")
+
+    def select_batch(self) -> list[dict]:
+        """
+        Очередь проценки: отмеченные позиции, не проценённые службой за последние DAEMON_REPRICE_INTERVAL,
+        начиная с позиций с самой старой датой цены. Дубли позиций проценяются один раз
+        :return: Не более self.batch позиций
+        """
+        now = time.monotonic()
+        queue = {}
+        for product in filtered_products_by_flag(self.all_products):
+            key = (product['number'], product['brand'])
+            priced_at = self._priced_at.get(key)
+            if key not in queue and (priced_at is None or now - priced_at >= DAEMON_REPRICE_INTERVAL):
+                queue[key] = product
+        self.progress['queue'] = len(queue)
+        queue = sorted(queue.values(), key=lambda product: product['updated_date'])
+        # Правила подставляются в копии позиций, чтобы не менять прочитанный список
+        return [dict(product) for product in queue[:self.batch]]
+
+    async def fetch_offers(self, products: list[dict]) -> list[list[dict] or None]:
+        """
+        Предложения ABCP по позициям. Предложения, полученные не раньше OFFER_CACHE_TTL, берём из памяти
+        :return: Список предложений в порядке позиций. None - ответ ABCP не получен
+        """
+        now = time.monotonic()
+        self.offer_cache = {key: value for key, value in self.offer_cache.items() if now - value[0] < OFFER_CACHE_TTL}
+        searches = search_keys(products)
+        missing = list({search for search in searches if search not in self.offer_cache})
+        self.progress['offer_cache_hits'] += len(searches) - len(missing)
+        if missing:
+            for search, offers in zip(missing, await self.work_abcp.get_prices_supplier(missing)):
+                if offers is not None:
+                    self.offer_cache[search] = (time.monotonic(), offers)
+        return [self.offer_cache[search][1] if search in self.offer_cache else None for search in searches]
+
+    def _price(self, products: list[dict], offers: list) -> int:
+        """
+        Применяем правила к позициям цикла и записываем цены и ошибки в хранилище
+        :return: Количество строк с ценами
+        """
+        products = evaluate_products(products, offers, self.own_warehouses, self._memo, self.workers)
+        self._memo.commit()
+        self._history.add_results(products)
+
+        products = add_result_to_all_product(products, self.all_products)
+        new_price_product, err_price_product = sort_price_products(products)
+        self._wk_g.set_price_products(new_price_product, len(self.all_products), name_column=['G', 'H', 'O', 'E'])
+        save_error(err_price_product, self._wk_g)
+        self._price_index.update(selected_prices(new_price_product))
+        return len(new_price_product)
+
+    async def run_cycle(self) -> int:
+        """
+        Один цикл проценки
+        :return: Количество позиций, по которым получен ответ ABCP
+        """
+        await self._run(self._reload)
+        products = self.select_batch()
+        if not products:
+            return 0
+        self.progress.update(state='pricing', batch=len(products))
+        products = selected_rule_for_position(products, self.rules)
+        products = await self._run(self._history.add_baselines, products)
+        offers = await self.fetch_offers(products)
+        await self._run(self._price, products, offers)
+
+        # Позиции без ответа ABCP остаются в очереди и проценяются в следующих циклах
+        now = time.monotonic()
+        priced = [product for product, result in zip(products, offers) if result is not None]
+        for product in priced:
+            self._priced_at[(product['number'], product['brand'])] = now
+        self.progress['priced'] += len(priced)
+        return len(priced)
+
+    async def run(self) -> None:
+        """Проценка по циклам до сигнала остановки. Текущий цикл при остановке завершается"""
+        while not self.stopping.is_set():
+            try:
+                count = await self.run_cycle()
+                self.progress.update(cycles=self.progress['cycles'] + 1, last_cycle=dt.now().isoformat(' ', 'seconds'))
+            except Exception as e:
+                logger.exception(f"Ошибка цикла проценки: {e}")
+                self.progress['last_error'] = f"{dt.now().isoformat(' ', 'seconds')} {e}"
+                count = 0
+            self.progress['state'] = 'idle'
+            if not count:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), DAEMON_IDLE_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+
+    def stop(self) -> None:
+        """Начинаем остановку: новые циклы не запускаются"""
+        if not self.stopping.is_set():
+            logger.info("Получен сигнал остановки, завершаем текущий цикл проценки")
+            self.stopping.set()
+            self.progress['state'] = 'draining'
+
+    async def close(self) -> None:
+        """Закрываем сессию ABCP и базы"""
+        await self.work_abcp.api_abcp.close()
+
+        def close_storage():
+            if self._wk_g is not None:
+                self._memo.close()
+                self._history.close()
+                if hasattr(self._wk_g, 'close'):
+                    self._wk_g.close()
+
+        await self._run(close_storage)
+        self._thread.shutdown()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Состояние службы. 503 во время остановки"""
+        return web.json_response(
+            {'status': 'draining' if self.stopping.is_set() else 'ok', 'uptime': int(time.time() - self.started),
+             'last_cycle': self.progress['last_cycle'], 'last_error': self.progress['last_error']},
+            status=503 if self.stopping.is_set() else 200
+        )
+
+    async def handle_progress(self, request: web.Request) -> web.Response:
+        """Ход проценки, лимит запросов к ABCP и состояние автомата защиты"""
+        limiter = self.work_abcp.limiter.stats()
+        return web.json_response({
+            **self.progress,
+            'offer_cache': len(self.offer_cache),
+            'abcp': {'limit': limiter['limit'], 'in_flight': limiter['in_flight'], 'p95': limiter['p95'],
+                     'breaker': self.work_abcp.breaker.state},
+        })
+
+
+async def serve(storage: str = 'google', workers: int = 1, batch: int = DAEMON_BATCH, port: int = DAEMON_PORT):
+    """
+    Запуск службы с HTTP сервером состояния на 127.0.0.1:port (/health, /progress).
+    SIGINT и SIGTERM останавливают службу после завершения текущего цикла
+    """
+    daemon = WorkDaemon(storage, workers, batch)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, daemon.stop)
+        except NotImplementedError:
+            # Windows: обработчик сигнала вызывается вне цикла событий
+            signal.signal(sig, lambda *args: loop.call_soon_threadsafe(daemon.stop))
+
+    app = web.Application()
+    app.router.add_get('/health', daemon.handle_health)
+    app.router.add_get('/progress', daemon.handle_progress)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    logger.info(f"... Служба проценки запущена, состояние: http://127.0.0.1:{port}/health")
+    try:
+        await daemon.run()
+    finally:
+        await daemon.close()
+        await runner.cleanup()
+        logger.info(f"... Служба проценки остановлена")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Служба непрерывной проценки по API ABCP')
+    parser.add_argument('--storage', choices=STORAGES, default='google',
+                        help='Хранилище позиций, правил и ошибок (по умолчанию google)')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='Количество процессов для применения правил (по умолчанию 1)')
+    parser.add_argument('--batch', type=int, default=DAEMON_BATCH, metavar='N',
+                        help=f'Количество позиций за цикл (по умолчанию {DAEMON_BATCH})')
+    parser.add_argument('--port', type=int, default=DAEMON_PORT,
+                        help=f'Порт HTTP сервера состояния (по умолчанию {DAEMON_PORT})')
+    args = parser.parse_args()
+    asyncio.run(serve(args.storage, args.workers, args.batch, args.port))
@@ -0,0 +1,109 @@
+import re
+import sqlite3
+
+from loguru import logger
+from datetime import datetime as dt, timedelta
+
+# Файл базы соответствия брендов таблицы брендам ABCP
+BRAND_DB: str = 'brand_aliases.db'
+
+# Через сколько дней повторно проверяем бренд позиции, для которой соответствие не найдено
+BRAND_MISS_DAYS: int = 30
+
+# Разные написания одного производителя. Ключи и значения - бренды после normalize
+BRAND_SYNONYMS: dict = {
+    'MANNFILTER': 'MANN',
+    'FEBIBILSTEIN': 'FEBI',
+    'LEMFOERDER': 'LEMFORDER',
+    'MERCEDESBENZ': 'MERCEDES',
+    'GENERALMOTORS': 'GM',
+    'HYUNDAIKIA': 'HYUNDAI',
+    'TOYOTALEXUS': 'TOYOTA',
+    'NISSANINFINITI': 'NISSAN',
+    'CONTITECH': 'CONTINENTAL',
+}
+
+
+class WorkBrands:
+    """
+    Класс для сопоставления брендов таблицы с брендами ABCP.
+    Если по бренду таблицы ABCP не находит позицию, то бренд определяется по списку брендов ABCP
+    для номера (search/brands). Найденное соответствие сохраняется в локальной базе SQLite
+    и используется при следующих запусках без повторных запросов.
+    """
+    def __init__(self, file_name: str = BRAND_DB):
+        self.file_name = file_name
+        self._conn = sqlite3.connect(file_name)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS brand_map (
+                brand TEXT PRIMARY KEY,
+                abcp_brand TEXT NOT NULL,
+                date TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS brand_misses (
+                brand TEXT NOT NULL,
+                number TEXT NOT NULL,
+                date TEXT NOT NULL,
+                PRIMARY KEY (brand, number)
+            );
+            """
+        )
+        self._conn.commit()
+        self._map = dict(self._conn.execute("SELECT brand, abcp_brand FROM brand_map"))
+
+    @staticmethod
+    def normalize(brand: str) -> str:
+        """Бренд в верхнем регистре без пробелов и разделителей, с заменой по BRAND_SYNONYMS"""
+        brand = re.sub(r'\W|_', '', str(brand)).upper()
+        return BRAND_SYNONYMS.get(brand, brand)
+
+    def get(self, brand: str) -> str or None:
+        """
+        Бренд ABCP для бренда таблицы
+        :return: Сохранённый бренд ABCP или None
+        """
+        return self._map.get(self.normalize(brand))
+
+    def is_miss(self, brand: str, number: str) -> bool:
+        """Соответствие для позиции уже искали за последние BRAND_MISS_DAYS дней и не нашли"""
+        date_start = (dt.now() - timedelta(days=BRAND_MISS_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        row = self._conn.execute(
+            "SELECT 1 FROM brand_misses WHERE brand = ? AND number = ? AND date >= ?",
+            (self.normalize(brand), number, date_start)
+        ).fetchone()
+        return row is not None
+
+    def match(self, brand: str, abcp_brands: list[str]) -> str or None:
+        """
+        Выбираем бренд ABCP, соответствующий бренду таблицы.
+        Сначала ищем совпадение после normalize, затем единственный бренд, который начинается с бренда таблицы
+        или с которого начинается бренд таблицы
+        :param brand: Бренд таблицы
+        :param abcp_brands: Бренды ABCP для номера позиции
+        :return: Бренд ABCP или None
+        """
+        normalized = self.normalize(brand)
+        candidates = {self.normalize(abcp_brand): abcp_brand for abcp_brand in abcp_brands}
+        if normalized in candidates:
+            return candidates[normalized]
+        similar = [abcp_brand for key, abcp_brand in candidates.items()
+                   if min(len(key), len(normalized)) >= 3 and (key.startswith(normalized) or normalized.startswith(key))]
+        return similar[0] if len(similar) == 1 else None
+
+    def put(self, brand: str, abcp_brand: str) -> None:
+        """Сохраняем соответствие бренда таблицы бренду ABCP"""
+        self._map[self.normalize(brand)] = abcp_brand
+        self._conn.execute("INSERT OR REPLACE INTO brand_map VALUES (?, ?, ?)",
+                           (self.normalize(brand), abcp_brand, dt.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def put_miss(self, brand: str, number: str) -> None:
+        """Сохраняем позицию, для которой соответствие бренда не найдено"""
+        self._conn.execute("INSERT OR REPLACE INTO brand_misses VALUES (?, ?, ?)",
+                           (self.normalize(brand), number, dt.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def close(self) -> None:
+        """Сохраняем изменения и закрываем соединение с базой"""
+        logger.info(f"Сохранено соответствий брендов ABCP: {len(self._map)}")
+        self._conn.commit()
+        self._conn.close()
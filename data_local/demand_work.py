@@ -0,0 +1,101 @@
+import re
+import sqlite3
+
+from loguru import logger
+from datetime import datetime as dt, timedelta
+
+# Файл базы позиций заказов покупателей
+DEMAND_DB: str = 'demand.db'
+
+# За сколько последних дней учитываем заказы при расчёте спроса
+DEMAND_DAYS: int = 30
+
+# Статус позиций заказов для загрузки спроса. None - все статусы
+DEMAND_STATUS = None
+
+
+def demand_key(brand: str, number: str) -> (str, str):
+    """
+    Ключ позиции для сопоставления заказов с таблицей: бренд в верхнем регистре
+    и номер без пробелов, дефисов и других разделителей
+    :return: (brand, number)
+    """
+    return str(brand).strip().upper(), re.sub(r'\W|_', '', str(number)).upper()
+
+
+class WorkDemand:
+    """
+    Класс для учёта спроса по позициям заказов покупателей в локальной базе SQLite.
+    Позиции заказов загружаются из ABCP инкрементально (только новые и изменённые заказы)
+    и хранятся по идентификатору позиции, поэтому повторно полученные заказы не удваивают спрос.
+    """
+    def __init__(self, file_name: str = DEMAND_DB):
+        self.file_name = file_name
+        self._conn = sqlite3.connect(file_name)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS order_positions (
+                position_id TEXT PRIMARY KEY,
+                brand TEXT NOT NULL,
+                number TEXT NOT NULL,
+                quantity REAL NOT NULL,
+                price REAL NOT NULL,
+                date TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_order_positions_date ON order_positions (date)")
+        self._conn.commit()
+
+    async def sync(self, date_create: str = None) -> int:
+        """
+        Загружаем позиции заказов, созданных или изменённых с прошлой синхронизации
+        :param date_create: Начальная дата создания заказов для первой синхронизации.
+        По умолчанию DEMAND_DAYS дней назад
+        :return: Количество загруженных позиций
+        """
+        from api_abcp.abcp_work import WorkABCP
+
+        if date_create is None:
+            date_create = (dt.now() - timedelta(days=DEMAND_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        work_abcp = WorkABCP()
+        async for order in work_abcp.iter_orders_by_status(DEMAND_STATUS, date_create):
+            date = str(order.get('date') or '')
+            for position in order.get('positions') or []:
+                brand, number = demand_key(position.get('brand', ''), position.get('number', ''))
+                rows.append((str(position.get('id') or f"{order.get('number')}-{brand}-{number}"), brand, number,
+                             self.convert_number(position.get('quantity')),
+                             self.convert_number(position.get('priceOut')), date))
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO order_positions VALUES (?, ?, ?, ?, ?, ?)", rows)
+        logger.info(f"Загрузили {len(rows)} позиций заказов покупателей")
+        if not work_abcp.orders_complete:
+            logger.warning("Заказы покупателей получены не полностью, спрос может быть занижен до следующей синхронизации")
+        return len(rows)
+
+    def demand(self, days: int = DEMAND_DAYS) -> dict:
+        """
+        Спрос по позициям за последние дни
+        :param days: Количество дней
+        :return: {demand_key(brand, number): {'quantity': количество, 'revenue': сумма продаж}}
+        """
+        date_start = (dt.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        cursor = self._conn.execute(
+            "SELECT brand, number, SUM(quantity), SUM(quantity * price) FROM order_positions "
+            "WHERE date >= ? GROUP BY brand, number", (date_start,)
+        )
+        return {(brand, number): {'quantity': quantity, 'revenue': revenue}
+                for brand, number, quantity, revenue in cursor}
+
+    @staticmethod
+    def convert_number(value) -> float:
+        """Преобразуем число из ответа ABCP или таблицы ('1 234,5') во float. Пустое значение - 0"""
+        try:
+            return float(str(value).replace('\xa0', '').replace(' ', '').replace(',', '.'))
+        except ValueError:
+            return 0.0
+
+    def close(self) -> None:
+        """Закрываем соединение с базой"""
+        self._conn.close()
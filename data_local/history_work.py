@@ -0,0 +1,103 @@
+import sqlite3
+import statistics
+
+from loguru import logger
+from datetime import datetime as dt
+
+# Файл базы истории выбранных цен
+HISTORY_DB: str = 'price_history.db'
+
+# Количество последних цен, по которым считается медиана для проверки отклонения цены
+HISTORY_DEPTH: int = 5
+
+
+class WorkHistory:
+    """
+    Класс для хранения истории выбранных предложений в локальной базе SQLite.
+    Записи индексированы по (brand, number, date), поэтому выбор последних цен по позиции
+    не зависит от объёма накопленной истории.
+    """
+    def __init__(self, file_name: str = HISTORY_DB):
+        self.file_name = file_name
+        self._conn = sqlite3.connect(file_name)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS price_history (
+                brand TEXT NOT NULL,
+                number TEXT NOT NULL,
+                date TEXT NOT NULL,
+                id_rule TEXT,
+                distributor_id TEXT,
+                price REAL NOT NULL,
+                delivery_period INTEGER
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_price_history ON price_history (brand, number, date)"
+        )
+        self._conn.commit()
+
+    def add_results(self, products: list[dict]) -> int:
+        """
+        Записываем в историю выбранные предложения по результатам проценки.
+        По каждой позиции берём предложение первого правила, по которому оно найдено
+        :param products: Список продуктов с ключом 'result' после применения правил
+        :return: Количество записанных цен
+        """
+        date_now = dt.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        for product in products:
+            for id_rule, rule_result in product.get('result', {}).get('id_rule', {}).items():
+                if rule_result.get('select_product'):
+                    offer = rule_result['select_product'][0]
+                    rows.append((product['brand'], product['number'], date_now, id_rule,
+                                 str(offer['distributorId']), float(offer['priceIn']), int(offer['deliveryPeriod'])))
+                    break
+
+        with self._conn:
+            self._conn.executemany("INSERT INTO price_history VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        logger.info(f"Записали в историю {len(rows)} выбранных цен")
+        return len(rows)
+
+    def last_prices(self, brand: str, number: str, count: int = HISTORY_DEPTH) -> list[float]:
+        """
+        Получаем последние цены по позиции, начиная с самой новой
+        :param brand: Бренд
+        :param number: Каталожный номер
+        :param count: Количество цен
+        :return: list[float]
+        """
+        cursor = self._conn.execute(
+            "SELECT price FROM price_history WHERE brand = ? AND number = ? ORDER BY date DESC LIMIT ?",
+            (brand, number, count)
+        )
+        return [row[0] for row in cursor]
+
+    def median_price(self, brand: str, number: str, count: int = HISTORY_DEPTH) -> float or None:
+        """
+        Скользящая медиана последних цен по позиции
+        :param brand: Бренд
+        :param number: Каталожный номер
+        :param count: Количество последних цен для расчёта медианы
+        :return: float or None, если истории по позиции нет
+        """
+        prices = self.last_prices(brand, number, count)
+        return statistics.median(prices) if prices else None
+
+    def add_baselines(self, products: list[dict], count: int = HISTORY_DEPTH) -> list[dict]:
+        """
+        Добавляем к продуктам базовую цену для проверки отклонения цены в ключ 'history_price'
+        :param products: Список продуктов
+        :param count: Количество последних цен для расчёта медианы
+        :return: Список продуктов с ключом 'history_price' (None, если истории нет)
+        """
+        for product in products:
+            product['history_price'] = self.median_price(product['brand'], product['number'], count)
+        logger.info(f"Базовая цена из истории определена по "
+                    f"{sum(product['history_price'] is not None for product in products)} позициям")
+        return products
+
+    def close(self) -> None:
+        """Закрываем соединение с базой"""
+        self._conn.close()
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import sqlite3
+
+from loguru import logger
+from datetime import datetime as dt
+from data_local.snapshot_work import OFFER_FIELDS
+
+# Файл базы сохранённых результатов применения правил
+MEMO_DB: str = 'result_memo.db'
+
+
+class WorkMemo:
+    """
+    Класс для повторного использования результата применения правил к продукту.
+    Результат сохраняется по бренду, номеру и списку правил позиции с хэшем предложений поставщиков,
+    правил продукта и его цены. Если при следующем запуске хэш совпал, то фильтрация по правилам не выполняется.
+    """
+    def __init__(self, file_name: str = MEMO_DB):
+        self.file_name = file_name
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(file_name)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(result_memo)")]
+        if columns and 'id_rule' not in columns:
+            # База предыдущей версии без списка правил в ключе. Сохранённые результаты просто пересчитаются
+            self._conn.execute("DROP TABLE result_memo")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS result_memo (
+                brand TEXT NOT NULL,
+                number TEXT NOT NULL,
+                id_rule TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (brand, number, id_rule)
+            )
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def rule_key(product: dict) -> str:
+        """
+        Список правил позиции для ключа сохранённого результата. Одинаковые позиции на разных строках листа
+        могут иметь разные правила, и их результаты хранятся отдельно
+        :param product: Данные по продукту. Правила 'id_rule' могут быть как строкой, так и словарём правил
+        :return: Идентификаторы правил через запятую
+        """
+        id_rule = product.get('id_rule') or ''
+        return ', '.join(id_rule) if isinstance(id_rule, dict) else str(id_rule)
+
+    @staticmethod
+    def make_hash(offers: list[dict], product: dict) -> str:
+        """
+        Хэш входных данных правил по продукту
+        :param offers: Предложения поставщиков без своих складов
+        :param product: Данные по продукту с правилами, подставленными selected_rule_for_position
+        :return: Хэш в виде строки
+        """
+        updated_date = product.get('updated_date')
+        data = {
+            'offers': [[offer.get(key) for key in OFFER_FIELDS] for offer in offers],
+            'rules': product['id_rule'],
+            'price': product.get('price'),
+            'history_price': product.get('history_price'),
+            'updated_date': updated_date.strftime('%d.%m.%Y') if isinstance(updated_date, dt) else updated_date,
+        }
+        return hashlib.blake2b(
+            json.dumps(data, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'), digest_size=16
+        ).hexdigest()
+
+    def get(self, product: dict, hash_value: str) -> dict or None:
+        """
+        Получаем сохранённый результат по продукту, если хэш входных данных не изменился
+        :param product: Данные по продукту
+        :param hash_value: Хэш из make_hash
+        :return: Сохранённый product['result'] или None
+        """
+        row = self._conn.execute(
+            "SELECT hash, result FROM result_memo WHERE brand = ? AND number = ? AND id_rule = ?",
+            (product['brand'], product['number'], self.rule_key(product))
+        ).fetchone()
+        if row and row[0] == hash_value:
+            self.hits += 1
+            return json.loads(row[1])
+        self.misses += 1
+        return None
+
+    def put(self, product: dict, hash_value: str) -> None:
+        """
+        Сохраняем результат применения правил по продукту
+        :param product: Данные по продукту с ключом 'result'
+        :param hash_value: Хэш из make_hash
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO result_memo VALUES (?, ?, ?, ?, ?)",
+            (product['brand'], product['number'], self.rule_key(product), hash_value,
+             json.dumps(product['result'], ensure_ascii=False))
+        )
+
+    def commit(self) -> None:
+        """Сохраняем изменения без закрытия соединения"""
+        self._conn.commit()
+
+    def close(self) -> None:
+        """Сохраняем изменения, выводим статистику и закрываем соединение с базой"""
+        total = self.hits + self.misses
+        logger.info(f"Результат правил взят из сохранённых: {self.hits} из {total} позиций"
+                    f"{f' ({self.hits / total:.0%})' if total else ''}")
+        self._conn.commit()
+        self._conn.close()
@@ -0,0 +1,87 @@
+import json
+import os
+import re
+
+from loguru import logger
+from datetime import datetime as dt
+
+# Файл индекса выбранных цен для сервиса цен
+PRICE_INDEX_FILE: str = 'price_index.json'
+
+# Поля выбранной цены в индексе
+PRICE_FIELDS: tuple = ('number', 'brand', 'price', 'distributor_id', 'route', 'id_rule', 'updated')
+
+
+def index_key(brand: str, number: str) -> str:
+    """Ключ индекса: бренд в верхнем регистре и номер без пробелов, дефисов и других разделителей"""
+    return '\t'.join((str(brand).strip().upper(), re.sub(r'\W|_', '', str(number)).upper()))
+
+
+class WorkPriceIndex:
+    """
+    Индекс выбранных цен по бренду и номеру для сервиса цен.
+    Хранится в памяти как словарь и в файле PRICE_INDEX_FILE. Файл перезаписывается целиком через
+    временный файл, поэтому сервис всегда читает полностью записанный индекс
+    """
+    def __init__(self, file_name: str = PRICE_INDEX_FILE):
+        self.file_name = file_name
+        self.prices = {}
+        self.created = ''
+        self.mtime = 0.0
+
+    def load(self) -> bool:
+        """
+        Считываем индекс из файла, если файл изменился с прошлого чтения
+        :return: True, если индекс считан
+        """
+        try:
+            mtime = os.stat(self.file_name).st_mtime
+            if mtime == self.mtime:
+                return False
+            with open(self.file_name, encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+        self.prices, self.created, self.mtime = data['prices'], data['created'], mtime
+        return True
+
+    def update(self, price_products: dict) -> int:
+        """
+        Добавляем найденные цены из результата проценки и сохраняем индекс.
+        Позиции, по которым последняя проценка не нашла предложение, удаляются из индекса, чтобы сервис
+        не отдавал отклонённую цену. Позиции без ответа ABCP ('stale') сохраняют прежнюю цену до следующей проценки
+        :param price_products: Выбранные цены из selected_prices {(number, brand): price_product}
+        :return: Количество обновлённых позиций
+        """
+        self.load()
+        updated = dt.now().isoformat(' ', 'seconds')
+        count, removed = 0, 0
+        for price_product in price_products.values():
+            key = index_key(price_product['brand'], price_product['number'])
+            if price_product.get('distributor_id') is None:
+                if not price_product.get('stale') and self.prices.pop(key, None) is not None:
+                    removed += 1
+                continue
+            row = {**price_product, 'price': price_product['new_price'], 'updated': updated}
+            self.prices[key] = {field: row[field] for field in PRICE_FIELDS}
+            count += 1
+        self.created = updated
+        self.save()
+        logger.info(f"Обновили индекс цен по {count} позициям, удалили {removed} позиций без предложения, "
+                    f"всего в индексе {len(self.prices)}")
+        return count
+
+    def save(self) -> None:
+        """Записываем индекс во временный файл и заменяем им PRICE_INDEX_FILE"""
+        temp_file = f"{self.file_name}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump({'created': self.created, 'prices': self.prices}, file, ensure_ascii=False)
+        os.replace(temp_file, self.file_name)
+        self.mtime = os.stat(self.file_name).st_mtime
+
+    def get(self, brand: str, number: str) -> dict or None:
+        """
+        Выбранная цена по позиции
+        :return: Словарь с ключами PRICE_FIELDS или None
+        """
+        return self.prices.get(index_key(brand, number))
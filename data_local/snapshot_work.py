@@ -0,0 +1,259 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from array import array
+from loguru import logger
+from datetime import datetime as dt
+
+# Папка для хранения снимков предложений поставщиков
+SNAPSHOT_DIR: str = 'snapshots'
+
+# Сигнатура и расширение файла снимка
+SNAPSHOT_MAGIC: bytes = b'GSPOFR1\0'
+SNAPSHOT_EXT: str = '.offers'
+
+# Колонки предложений поставщика, которые используются правилами проценки, и их тип в формате модуля array.
+# Строковые значения хранятся номером строки в общем списке строк снимка
+OFFER_COLUMNS: tuple = (
+    ('priceIn', 'd'),
+    ('deliveryPeriod', 'i'),
+    ('availability', 'i'),
+    ('deliveryProbability', 'd'),
+    ('distributorId', 'q'),
+    ('supplierCode', 'i'),
+    ('supplierDescription', 'i'),
+    ('description', 'i'),
+    ('product', 'i'),
+    ('timestamp', 'd'),
+)
+STRING_COLUMNS: tuple = ('supplierCode', 'supplierDescription', 'description')
+
+# Поля предложения, которые возвращаются при чтении снимка
+OFFER_FIELDS: tuple = ('priceIn', 'deliveryPeriod', 'availability', 'deliveryProbability', 'distributorId',
+                       'supplierCode', 'supplierDescription', 'description')
+
+# Поля продукта, которые нужны для повторной проценки без обращения к Google таблице
+PRODUCT_FIELDS: tuple = ('number', 'alias_number', 'brand', 'alias_brand', 'description', 'price', 'updated_date',
+                         'id_rule', 'row_product_on_sheet', 'history_price')
+
+
+class WorkSnapshot:
+    """
+    Класс для сохранения снимков предложений поставщиков, полученных от ABCP за один запуск.
+    Снимок позволяет повторно выполнить проценку по текущим или новым правилам без запросов к API ABCP.
+    Предложения хранятся по колонкам фиксированного типа, поэтому файл читается через mmap
+    без разбора предложений всех продуктов.
+    """
+    def __init__(self, path: str = SNAPSHOT_DIR):
+        self.path = path
+        self._products = []
+        self._columns = {name: array(typecode) for name, typecode in OFFER_COLUMNS}
+        self._offsets = array('q', [0])
+        self._strings = []
+        self._string_index = {}
+
+    def add(self, product: dict, offers: list[dict]) -> None:
+        """
+        Добавляем в снимок предложения поставщиков по продукту
+        :param product: Данные по продукту. Правила 'id_rule' могут быть как строкой, так и словарём правил
+        :param offers: Список предложений от ABCP до исключения своих складов
+        :return: None
+        """
+        item = {key: product.get(key) for key in PRODUCT_FIELDS}
+        if isinstance(item['id_rule'], dict):
+            item['id_rule'] = ', '.join(item['id_rule'])
+        if isinstance(item['updated_date'], dt):
+            item['updated_date'] = item['updated_date'].strftime('%d.%m.%Y')
+        item['selected'] = None
+
+        product_index = len(self._products)
+        timestamp = time.time()
+        columns = self._columns
+        for offer in offers:
+            columns['priceIn'].append(self.convert_number(offer.get('priceIn'), float))
+            columns['deliveryPeriod'].append(self.convert_number(offer.get('deliveryPeriod'), int))
+            columns['availability'].append(self.convert_number(offer.get('availability'), int))
+            columns['deliveryProbability'].append(self.convert_number(offer.get('deliveryProbability'), float))
+            columns['distributorId'].append(self.convert_number(offer.get('distributorId'), int))
+            for name in STRING_COLUMNS:
+                columns[name].append(self._intern(offer.get(name)))
+            columns['product'].append(product_index)
+            columns['timestamp'].append(timestamp)
+
+        self._products.append(item)
+        self._offsets.append(len(columns['product']))
+
+    def save(self, own_warehouses: list, price_products: dict) -> str:
+        """
+        Записываем снимок в файл.
+        Формат файла: сигнатура, длина заголовка, заголовок в JSON (продукты, строки, расположение колонок),
+        затем колонки предложений и индекс смещений продуктов, выровненные по 8 байт
+        :param own_warehouses: Список своих складов на момент запуска
+        :param price_products: Выбранные цены по позициям {(number, brand): price_product}
+        :return: Имя файла снимка
+        """
+        for item in self._products:
+            price_product = price_products.get((item['number'], item['brand']))
+            if price_product is not None:
+                item['selected'] = {
+                    'new_price': price_product['new_price'],
+                    'distributor_result': price_product['distributor_result']
+                }
+
+        columns = dict(self._columns, offsets=self._offsets)
+        layout = {}
+        position = 0
+        for name, column in columns.items():
+            layout[name] = {'typecode': column.typecode, 'itemsize': column.itemsize, 'offset': position,
+                            'length': len(column)}
+            position += self._align(len(column) * column.itemsize)
+
+        header = json.dumps({
+            'created': dt.now().strftime('%d.%m.%Y %H:%M:%S'),
+            'byteorder': sys.byteorder,
+            'own_warehouses': own_warehouses,
+            'products': self._products,
+            'strings': self._strings,
+            'columns': layout
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        header += b' ' * (self._align(len(SNAPSHOT_MAGIC) + 8 + len(header)) - len(SNAPSHOT_MAGIC) - 8 - len(header))
+
+        os.makedirs(self.path, exist_ok=True)
+        file_name = os.path.join(self.path, f"offers_{dt.now().strftime('%Y%m%d_%H%M%S')}{SNAPSHOT_EXT}")
+        with open(file_name, 'wb') as file:
+            file.write(SNAPSHOT_MAGIC)
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            for column in columns.values():
+                data = column.tobytes()
+                file.write(data + b'\0' * (self._align(len(data)) - len(data)))
+
+        logger.info(f"Сохранили снимок предложений по {len(self._products)} позициям "
+                    f"({len(self._columns['product'])} предложений) в файл {file_name}")
+        return file_name
+
+    def load(self, file_name: str = '') -> 'SnapshotReader':
+        """
+        Открываем снимок для чтения
+        :param file_name: Имя файла снимка. Если не указано, то берём последний снимок из папки self.path
+        :return: SnapshotReader
+        """
+        file_name = file_name or self.last_file()
+        reader = SnapshotReader(file_name)
+        logger.info(f"Считали снимок от {reader.created} по {len(reader.products)} позициям из файла {file_name}")
+        return reader
+
+    def last_file(self) -> str:
+        """
+        Определяем последний по времени снимок в папке self.path
+        :return: Имя файла снимка
+        """
+        files = sorted(
+            name for name in os.listdir(self.path) if name.startswith('offers_') and name.endswith(SNAPSHOT_EXT)
+        )
+        if not files:
+            raise FileNotFoundError(f"В папке {self.path} нет снимков предложений")
+        return os.path.join(self.path, files[-1])
+
+    def _intern(self, value) -> int:
+        """Возвращаем номер строки в общем списке строк снимка, добавляя строку при первом появлении"""
+        value = '' if value is None else str(value)
+        index = self._string_index.get(value)
+        if index is None:
+            index = self._string_index[value] = len(self._strings)
+            self._strings.append(value)
+        return index
+
+    @staticmethod
+    def convert_number(value, type_value: type) -> int or float:
+        """
+        Преобразуем числовое значение предложения к типу колонки. Пустые значения записываем как 0
+        :param value: Значение из ответа ABCP
+        :param type_value: int или float
+        :return: int or float
+        """
+        try:
+            return type_value(float(value))
+        except (TypeError, ValueError):
+            return type_value(0)
+
+    @staticmethod
+    def _align(size: int) -> int:
+        """Выравниваем размер блока по 8 байт"""
+        return (size + 7) // 8 * 8
+
+
+class SnapshotReader:
+    """
+    Чтение снимка предложений через mmap.
+    Предложения продукта собираются только из его среза колонок по индексу смещений
+    """
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self._file = open(file_name, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            self.close()
+            raise ValueError(f"Файл {file_name} не является снимком предложений")
+
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        header_length = struct.unpack('<Q', self._mmap[len(SNAPSHOT_MAGIC):header_start])[0]
+        header = json.loads(self._mmap[header_start:header_start + header_length].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError(f"Снимок {file_name} записан с другим порядком байт")
+
+        self.created = header['created']
+        self.own_warehouses = header['own_warehouses']
+        self.products = header['products']
+        for product in self.products:
+            product['updated_date'] = dt.strptime(product['updated_date'], '%d.%m.%Y')
+        self._strings = header['strings']
+
+        data_start = header_start + header_length
+        self._views = [memoryview(self._mmap)]
+        self._columns = {}
+        for name, column in header['columns'].items():
+            start = data_start + column['offset']
+            self._views.append(self._views[0][start:start + column['length'] * column['itemsize']])
+            self._views.append(self._views[-1].cast(column['typecode']))
+            self._columns[name] = self._views[-1]
+        self._offsets = self._columns.pop('offsets')
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def offers(self, index: int) -> list[dict]:
+        """
+        Получаем предложения продукта по его номеру в снимке
+        :param index: Номер продукта в списке self.products
+        :return: Список предложений с ключами OFFER_FIELDS
+        """
+        start, end = self._offsets[index], self._offsets[index + 1]
+        strings = self._strings
+        values = []
+        for name in OFFER_FIELDS:
+            column = self._columns[name][start:end].tolist()
+            values.append([strings[i] for i in column] if name in STRING_COLUMNS else column)
+        return [dict(zip(OFFER_FIELDS, offer)) for offer in zip(*values)]
+
+    def close(self) -> None:
+        """Освобождаем mmap и закрываем файл"""
+        self._columns = {}
+        self._offsets = None
+        for view in reversed(getattr(self, '_views', [])):
+            view.release()
+        self._views = []
+        if not self._mmap.closed:
+            self._mmap.close()
+        self._file.close()
@@ -0,0 +1,243 @@
+import sqlite3
+
+from loguru import logger
+from datetime import datetime as dt
+
+# Файл локальной базы позиций, правил и ошибок
+STORAGE_DB: str = 'storage.db'
+# Время ожидания снятия блокировки базы другим подключением (служба, части проценки), сек
+STORAGE_TIMEOUT: float = 60.0
+# Срок хранения ошибок, если он не загружен вместе с правилами, дней
+DAYS_LOG_DEFAULT: int = 7
+
+# Колонки позиций в том же порядке, что и на первой странице Google таблицы
+PRODUCT_COLUMNS: list = ['number', 'alias_number', 'brand', 'alias_brand', 'description', 'stock', 'price',
+                         'updated_date', 'turn_ratio', 'norm_stock', 'product_group', 'rule', 'select_flag', 'id_rule']
+
+# Колонки правил в том же порядке, что и на второй странице Google таблицы
+RULE_COLUMNS: list = ['id_rule', 'type_rule', 'rule_value', 'type_select_supplier', 'id_suppliers',
+                      'type_select_routes', 'name_routes', 'type_select_supplier_storage', 'supplier_storage',
+                      'supplier_storage_min_stock', 'delivery_probability', 'max_delivery_period',
+                      'type_selection_rule', 'price_deviation']
+
+# Колонки ошибок в том же порядке, что и на третьей странице Google таблицы
+ERROR_COLUMNS: list = ['last_update_date', 'number', 'brand', 'description', 'id_rule',
+                       'first_result', 'filter_by_supplier', 'filter_by_routes', 'filter_by_storage',
+                       'filter_by_min_stock', 'filter_by_delivery_probability', 'filter_by_delivery_period',
+                       'filter_by_price_deviation', 'select_count_product']
+
+
+class WorkSQLite:
+    """
+    Хранилище позиций, правил и ошибок проценки в локальной базе SQLite.
+    Повторяет методы WorkGoogle, поэтому может использоваться вместо Google таблицы для больших каталогов.
+    Номер строки позиции 'row_product_on_sheet' сохраняется, чтобы результаты можно было перенести в таблицу
+    """
+    def __init__(self, file_name: str = STORAGE_DB):
+        self.file_name = file_name
+        self._conn = sqlite3.connect(file_name, timeout=STORAGE_TIMEOUT)
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        """Создаём таблицы и индексы, если их ещё нет"""
+        product_columns = ', '.join(f"{column} TEXT" for column in PRODUCT_COLUMNS if column != 'price')
+        rule_columns = ', '.join(f"{column} TEXT" for column in RULE_COLUMNS)
+        error_columns = ', '.join(f"{column} TEXT" for column in ERROR_COLUMNS)
+        self._conn.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS products (
+                row_product_on_sheet INTEGER PRIMARY KEY, {product_columns}, price REAL,
+                distributor_result TEXT, selected_rule TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_products_key ON products (brand, number);
+            CREATE INDEX IF NOT EXISTS idx_products_select ON products (select_flag);
+            CREATE TABLE IF NOT EXISTS rules (row_price_filter_on_sheet INTEGER PRIMARY KEY, {rule_columns});
+            CREATE INDEX IF NOT EXISTS idx_rules_id ON rules (id_rule);
+            CREATE TABLE IF NOT EXISTS errors (id INTEGER PRIMARY KEY AUTOINCREMENT, {error_columns});
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._conn.commit()
+
+    def get_products(self) -> list[dict]:
+        """
+        Получаем все позиции
+        :return: list[dict] с ключами как у WorkGoogle.get_products
+        """
+        return list(self.iter_products())
+
+    def iter_products(self):
+        """
+        Позиции по одной в порядке строк
+        :return: Генератор словарей с ключами как у WorkGoogle.get_products
+        """
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(PRODUCT_COLUMNS)}, row_product_on_sheet FROM products ORDER BY row_product_on_sheet"
+        )
+        for val in cursor:
+            product = dict(zip(PRODUCT_COLUMNS, ('' if value is None else value for value in val)))
+            product['price'] = val[PRODUCT_COLUMNS.index('price')]
+            product['updated_date'] = self.convert_date(product['updated_date'])
+            product['row_product_on_sheet'] = val[-1]
+            yield product
+
+    def get_rule_for_selected_products(self) -> dict:
+        """
+        Получаем правила выбора позиций продукта
+        :return: {'count_products', 'days_interval'}
+        """
+        return {'count_products': int(self._get_setting('count_products', '0')),
+                'days_interval': int(self._get_setting('days_interval', '0'))}
+
+    def get_price_filter_rules(self) -> (list[dict], list):
+        """
+        Получаем правила проценки и список своих складов
+        :return: (price_filter_rules, own_warehouses) как у WorkGoogle.get_price_filter_rules
+        """
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(RULE_COLUMNS)}, row_price_filter_on_sheet FROM rules ORDER BY row_price_filter_on_sheet"
+        )
+        price_filter_rules = []
+        for val in cursor:
+            price_filter_rule = dict(zip(RULE_COLUMNS, ('' if value is None else value for value in val)))
+            for key in ('type_select_supplier', 'type_select_routes', 'type_select_supplier_storage'):
+                price_filter_rule[key] = self.convert_black_white_to_bool(price_filter_rule[key])
+            price_filter_rule['name_routes'] = price_filter_rule['name_routes'].replace(" ", "").split(",")
+            price_filter_rule['row_price_filter_on_sheet'] = val[-1]
+            price_filter_rules.append(price_filter_rule)
+
+        own_warehouses = self._get_setting('own_warehouses', '').replace(" ", "").split(",")
+        return price_filter_rules, own_warehouses
+
+    def get_error(self) -> (list[dict], int):
+        """
+        Получаем список ошибок
+        :return: (list_error, days_log)
+        """
+        cursor = self._conn.execute(f"SELECT {', '.join(ERROR_COLUMNS)} FROM errors ORDER BY id")
+        list_error = []
+        for val in cursor:
+            error = dict(zip(ERROR_COLUMNS, val))
+            error['last_update_date'] = self.convert_date(error['last_update_date'])
+            list_error.append(error)
+        return list_error, int(self._get_setting('days_log', str(DAYS_LOG_DEFAULT)))
+
+    def set_selected_products(self, filtered_products: list[dict], count_row: int or str, name_column: str) -> None:
+        """
+        Записываем информацию о выборе позиции для последующего получения цены
+        :param filtered_products: Обязательный ключ [{'row_product_on_sheet': номер строки int or str}]
+        :param count_row: Не используется, оставлен для совместимости с WorkGoogle
+        :param name_column: Не используется, оставлен для совместимости с WorkGoogle
+        """
+        with self._conn:
+            self._conn.execute("UPDATE products SET selected_rule = ''")
+            self._conn.executemany(
+                "UPDATE products SET selected_rule = ? WHERE row_product_on_sheet = ?",
+                ((str(product['id_rule']), int(product['row_product_on_sheet'])) for product in filtered_products)
+            )
+
+    def set_price_products(self, filtered_products: list[dict], count_row: int or str, name_column: list[str]) -> None:
+        """
+        Записываем цену, дату её получения, результат и описание позиций
+        :param filtered_products: Обязательный ключ [{'row_product_on_sheet': номер строки int or str}]
+        :param count_row: Не используется, оставлен для совместимости с WorkGoogle
+        :param name_column: Не используется, оставлен для совместимости с WorkGoogle
+        """
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE products SET price = ?, updated_date = ?, distributor_result = ?, description = ? "
+                "WHERE row_product_on_sheet = ?",
+                ((product['new_price'], product['last_update_date'], product['distributor_result'],
+                  product['description'], int(product['row_product_on_sheet'])) for product in filtered_products)
+            )
+        logger.info(f"Записали цены по {len(filtered_products)} позициям в {self.file_name}")
+
+    def save_new_result_on_sheet(self, data: list[dict], worksheet_id: int, start_row_index: int):
+        """
+        Перезаписываем ошибки проценки
+        :param data: Данные для записи с ключами ERROR_COLUMNS
+        :param worksheet_id: Не используется, оставлен для совместимости с WorkGoogle
+        :param start_row_index: Не используется, оставлен для совместимости с WorkGoogle
+        """
+        with self._conn:
+            self._conn.execute("DELETE FROM errors")
+            self._conn.executemany(
+                f"INSERT INTO errors ({', '.join(ERROR_COLUMNS)}) VALUES ({', '.join('?' * len(ERROR_COLUMNS))})",
+                ([str(value[column]) for column in ERROR_COLUMNS] for value in data)
+            )
+
+    def import_products(self, sheet_products: list[list[str]]) -> int:
+        """
+        Загружаем позиции из строк первой страницы Google таблицы или её выгрузки в CSV
+        :param sheet_products: Строки страницы, включая заголовок
+        :return: Количество загруженных позиций
+        """
+        rows = []
+        for i, val in enumerate(sheet_products[1:], start=2):
+            product = dict(zip(PRODUCT_COLUMNS, val))
+            price = product.get('price', '')
+            product['price'] = float(price.replace('\xa0', '').replace(',', '.')) if price else None
+            rows.append([i] + [product.get(column, '') for column in PRODUCT_COLUMNS])
+        with self._conn:
+            self._conn.execute("DELETE FROM products")
+            self._conn.executemany(
+                f"INSERT INTO products (row_product_on_sheet, {', '.join(PRODUCT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(PRODUCT_COLUMNS) + 1))})", rows
+            )
+        logger.info(f"Загрузили {len(rows)} позиций в {self.file_name}")
+        return len(rows)
+
+    def import_rules(self, sheet_price_filter_rules: list[list[str]], days_log: int or str = '') -> int:
+        """
+        Загружаем правила и настройки из строк второй страницы Google таблицы или её выгрузки в CSV
+        :param sheet_price_filter_rules: Строки страницы, включая заголовки
+        :param days_log: Срок хранения ошибок, дней (ячейка C1 третьей страницы). Если не задан,
+            то сохраняется загруженный ранее, а без него используется DAYS_LOG_DEFAULT
+        :return: Количество загруженных правил
+        """
+        rows = [[i] + [val[j] if j < len(val) else '' for j in range(len(RULE_COLUMNS))]
+                for i, val in enumerate(sheet_price_filter_rules[6:], start=7)]
+        settings = {
+            'own_warehouses': sheet_price_filter_rules[1][4],
+            'count_products': sheet_price_filter_rules[1][2],
+            'days_interval': sheet_price_filter_rules[2][2],
+        }
+        if str(days_log).strip():
+            settings['days_log'] = str(int(days_log))
+        elif not self._get_setting('days_log', ''):
+            logger.warning(f"Срок хранения ошибок не загружен, используется {DAYS_LOG_DEFAULT} дн.")
+        with self._conn:
+            self._conn.execute("DELETE FROM rules")
+            self._conn.executemany(
+                f"INSERT INTO rules (row_price_filter_on_sheet, {', '.join(RULE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(RULE_COLUMNS) + 1))})", rows
+            )
+            self._conn.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)", settings.items())
+        logger.info(f"Загрузили {len(rows)} правил в {self.file_name}")
+        return len(rows)
+
+    def _get_setting(self, key: str, default: str) -> str:
+        """Значение настройки или default, если настройка не задана"""
+        row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row and row[0] else default
+
+    @staticmethod
+    def convert_date(date: str) -> dt:
+        """
+        Преобразуем дату в формате '%d.%m.%Y' так же, как WorkGoogle.convert_date
+        :return: Дата в формате datetime.datetime(2024, 01, 01, 0, 0)
+        """
+        return dt.strptime(date, '%d.%m.%Y') if date else dt.strptime('01.01.2024', '%d.%m.%Y')
+
+    @staticmethod
+    def convert_black_white_to_bool(value: str) -> bool:
+        """
+        Преобразуем тип списка так же, как WorkGoogle.convert_black_white_to_bool
+        :return: True - белый список, False - черный список, None - не задано
+        """
+        value = value.lower()
+        return True if value == "белый список" else False if value == "черный список" else None
+
+    def close(self) -> None:
+        """Закрываем соединение с базой"""
+        self._conn.close()
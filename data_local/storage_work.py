@@ -0,0 +1,64 @@
+from typing import Protocol
+
+# Доступные хранилища позиций, правил и ошибок
+STORAGES: tuple = ('google', 'sqlite')
+
+
+class Storage(Protocol):
+    """
+    Интерфейс хранилища позиций, правил и ошибок проценки.
+    Реализации: WorkGoogle (Google таблица) и WorkSQLite (локальная база SQLite)
+    """
+    def get_products(self) -> list[dict]:
+        """Позиции товаров с ключами, как у WorkGoogle.get_products"""
+
+    def iter_products(self):
+        """Позиции товаров по одной, по мере чтения"""
+
+    def get_price_filter_rules(self) -> (list[dict], list):
+        """Правила проценки и список своих складов"""
+
+    def get_error(self) -> (list[dict], int):
+        """Сохранённые ошибки проценки и количество дней их хранения"""
+
+    def set_price_products(self, filtered_products: list[dict], count_row: int or str, name_column: list[str]) -> None:
+        """Записываем выбранные цены"""
+
+    def set_selected_products(self, filtered_products: list[dict], count_row: int or str, name_column: str) -> None:
+        """Записываем выбранные для проценки позиции"""
+
+    def save_new_result_on_sheet(self, data: list[dict], worksheet_id: int, start_row_index: int):
+        """Перезаписываем ошибки проценки"""
+
+
+def call_storage(name: str, method: str, *args, location: str = ''):
+    """
+    Вызываем метод отдельного экземпляра хранилища. У каждого экземпляра своё подключение,
+    поэтому такие вызовы можно выполнять одновременно в разных потоках
+    :param name: 'google' или 'sqlite'
+    :param method: Имя метода Storage
+    :param location: id Google таблицы или файл базы SQLite. По умолчанию из настроек
+    :return: Результат метода
+    """
+    storage = get_storage(name, location)
+    try:
+        return getattr(storage, method)(*args)
+    finally:
+        if hasattr(storage, 'close'):
+            storage.close()
+
+
+def get_storage(name: str = 'google', location: str = '') -> Storage:
+    """
+    Создаём хранилище по имени. Модули хранилищ импортируются только при выборе
+    :param name: 'google' или 'sqlite'
+    :param location: id Google таблицы или файл базы SQLite. По умолчанию из настроек
+    :return: Storage
+    """
+    if name == 'sqlite':
+        from data_local.sqlite_work import WorkSQLite, STORAGE_DB
+        return WorkSQLite(location or STORAGE_DB)
+    if name == 'google':
+        from google_table.google_tb_work import WorkGoogle
+        return WorkGoogle(location)
+    raise ValueError(f"Неизвестное хранилище {name}, доступные: {', '.join(STORAGES)}")
@@ -1,27 +1,86 @@
+import json
+import os
+
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
 from config import AUTH_GOOGLE
 from loguru import logger
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
+
+# Файл с сохранённым токеном доступа сервисного аккаунта
+TOKEN_CACHE: str = 'google_table/token_cache.json'
 
 
 class RWGoogle:
     """
-    Класс для чтения и запись данных из(в) Google таблицы(у)
+    Класс для чтения и запись данных из(в) Google таблицы(у).
+    Подключение к Google выполняется при первом обращении к таблице,
+    токен доступа сохраняется в TOKEN_CACHE и используется до окончания срока его действия
     """
-    def __init__(self):
+    def __init__(self, key_wb: str = ''):
+        """
+        :param key_wb: id Google таблицы. По умолчанию AUTH_GOOGLE['KEY_WORKBOOK']
+        """
         self.client_id = AUTH_GOOGLE['GOOGLE_CLIENT_ID']
         self.client_secret = AUTH_GOOGLE['GOOGLE_CLIENT_SECRET']
         self._scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        self._credentials = ServiceAccountCredentials.from_json_keyfile_name(
+        self._client = None
+        self.key_wb = key_wb or AUTH_GOOGLE['KEY_WORKBOOK']
+
+    @property
+    def _gc(self) -> gspread.Client:
+        """Клиент gspread, создаётся при первом обращении"""
+        if self._client is None:
+            self._client = self._authorize()
+        return self._client
+
+    def _authorize(self) -> gspread.Client:
+        """
+        Авторизуемся в Google. Если сохранённый токен ещё действует, то новый токен не запрашиваем
+        :return: gspread.Client
+        """
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(
             'google_table/credentials.json', self._scope
             # 'credentials.json', self._scope
         )
-        self._credentials._client_id = self.client_id
-        self._credentials._client_secret = self.client_secret
-        self._gc = gspread.authorize(self._credentials)
-        self.key_wb = AUTH_GOOGLE['KEY_WORKBOOK']
+        credentials._client_id = self.client_id
+        credentials._client_secret = self.client_secret
+        client = gspread.authorize(credentials)
+
+        auth = client.http_client.auth
+        try:
+            with open(TOKEN_CACHE, encoding='utf-8') as file:
+                cache = json.load(file)
+            if cache['client_email'] == auth.service_account_email:
+                auth.token = cache['token']
+                auth.expiry = dt.fromisoformat(cache['expiry'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # Обновляем токен заранее, чтобы он не истёк во время работы программы
+        if not auth.token or auth.expiry is None or auth.expiry - timedelta(minutes=5) <= dt.utcnow():
+            from google.auth.transport.requests import Request
+
+            auth.refresh(Request())
+            self._save_token(auth)
+        else:
+            logger.debug(f"Используем сохранённый токен Google до {auth.expiry}")
+        return client
+
+    @staticmethod
+    def _save_token(auth) -> None:
+        """
+        Сохраняем токен доступа в TOKEN_CACHE. Файл доступен только владельцу
+        :param auth: google.oauth2.service_account.Credentials
+        """
+        try:
+            fd = os.open(TOKEN_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({'client_email': auth.service_account_email, 'token': auth.token,
+                           'expiry': auth.expiry.isoformat()}, file)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить токен Google: {e}")
 
     def read_sheets(self) -> list[str]:
         """
@@ -147,8 +206,8 @@ class RWGoogle:
 
 
 class WorkGoogle:
-    def __init__(self):
-        self._rw_google = RWGoogle()
+    def __init__(self, key_wb: str = ''):
+        self._rw_google = RWGoogle(key_wb)
 
     def get_products(self) -> list[dict]:
         """
@@ -171,17 +230,23 @@ class WorkGoogle:
             'id_rule' - ID правила для получения цены
             },...]
         """
+        return list(self.iter_products())
+
+    def iter_products(self):
+        """
+        Позиции первой страницы по одной, по мере разбора строк. Ключи как у get_products.
+        Страница читается целиком одним запросом, по одной отдаются уже прочитанные строки
+        :return: Генератор словарей позиций
+        """
         sheet_products = self._rw_google.read_sheet(0)
         params_head = ['number', 'alias_number', 'brand', 'alias_brand', 'description', 'stock', 'price',
                        'updated_date', 'turn_ratio', 'norm_stock', 'product_group', 'rule', 'select_flag', 'id_rule']
-        products = []
         for i, val in enumerate(sheet_products[1:], start=2):
             product = dict(zip(params_head, val))
             product['price'] = self.convert_price(str(product['price']))
             product['updated_date'] = self.convert_date(str(product['updated_date']))
             product['row_product_on_sheet'] = i
-            products.append(product)
-        return products
+            yield product
 
     def get_rule_for_selected_products(self) -> dict:
         """
@@ -212,22 +277,31 @@ class WorkGoogle:
             'delivery_probability' - Вероятность поставки,
             'max_delivery_period' - Максимальный период поставки,
             'type_selection_rule' - Тип правила отбора позиций,
-            'selection_rule' - Правила отбора позиций
+            'price_deviation' - Допустимое отклонение цены, %
             },...]
         `ID правила`, `тип правила`, `значение правила`, `тип отбора поставщиков`, `поставщики`, `тип отбора маршрута`,
         `маршруты`, `тип отбора складов`, `склады`, `минимальный остаток`, `вероятность`,
         `Допустимый срок, дней`, `Цена или срок`, `отклонение цены, %`
         """
         sheet_price_filter_rules = self._rw_google.read_sheet(1)
+        return self.parse_price_filter_rules(sheet_price_filter_rules)
 
+    @classmethod
+    def parse_price_filter_rules(cls, sheet_price_filter_rules: list[list[str]]) -> (list[dict], list):
+        """
+        Преобразуем строки страницы с правилами в список правил и список своих складов.
+        Строки могут быть получены как из Google таблицы, так и из выгрузки этой страницы в CSV
+        :param sheet_price_filter_rules: Все строки страницы с правилами, включая заголовки
+        :return: (price_filter_rules, own_warehouses)
+        """
         params_head = ['id_rule', 'type_rule', 'rule_value', 'type_select_supplier', 'id_suppliers',
                        'type_select_routes', 'name_routes', 'type_select_supplier_storage', 'supplier_storage',
                        'supplier_storage_min_stock', 'delivery_probability', 'max_delivery_period',
-                       'type_selection_rule', 'selection_rule']
+                       'type_selection_rule', 'price_deviation']
         price_filter_rules = []
         for i, val in enumerate(sheet_price_filter_rules[6:], start=7):
             price_filter_rule = dict(zip(params_head, val))
-            price_filter_rule = self.convert_value_rule(price_filter_rule)
+            price_filter_rule = cls.convert_value_rule(price_filter_rule)
             price_filter_rule['name_routes'] = price_filter_rule['name_routes'].replace(" ", "").split(",")
             price_filter_rule['row_price_filter_on_sheet'] = i
             price_filter_rules.append(price_filter_rule)
@@ -292,7 +366,8 @@ class WorkGoogle:
         """
         return float(price_str.replace('\xa0', '').replace(',', '.')) if price_str else None
 
-    def convert_value_rule(self, dict_rule: dict) -> dict:
+    @classmethod
+    def convert_value_rule(cls, dict_rule: dict) -> dict:
         """
         Преобразуем формат ключей правил для дальнейшей работы программы
         Преобразовывает значения словаря полученных правил 'type_select_supplier', 'type_select_routes' и
@@ -303,9 +378,9 @@ class WorkGoogle:
         :param dict_rule: Словарь с ключами 'date_start', 'last_start', 'time_start', 'time_finish' и 'repeat'
         :return: Преобразованный словарь
         """
-        dict_rule['type_select_supplier'] = self.convert_black_white_to_bool(dict_rule['type_select_supplier'])
-        dict_rule['type_select_routes'] = self.convert_black_white_to_bool(dict_rule['type_select_routes'])
-        dict_rule['type_select_supplier_storage'] = self.convert_black_white_to_bool(
+        dict_rule['type_select_supplier'] = cls.convert_black_white_to_bool(dict_rule['type_select_supplier'])
+        dict_rule['type_select_routes'] = cls.convert_black_white_to_bool(dict_rule['type_select_routes'])
+        dict_rule['type_select_supplier_storage'] = cls.convert_black_white_to_bool(
             dict_rule['type_select_supplier_storage']
         )
         return dict_rule
@@ -394,5 +469,6 @@ class WorkGoogle:
         logger.debug(f"{values=}")
 
         self._rw_google.save_batch(0, values)
+        logger.info(f"Записали цены по {len(filtered_products)} позициям на лист")
 
 
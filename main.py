@@ -1,12 +1,51 @@
 # Author Loik Andrey mail: loikand@mail.ru
+import argparse
 import asyncio
-
+import csv
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from collections import Counter
 from config import FILE_NAME_LOG
-from google_table.google_tb_work import WorkGoogle
 from loguru import logger
-from api_abcp.abcp_work import WorkABCP
+from data_local.brand_work import WorkBrands
+from data_local.demand_work import WorkDemand, demand_key
+from data_local.history_work import WorkHistory
+from data_local.memo_work import WorkMemo
+from data_local.price_index_work import WorkPriceIndex
+from data_local.snapshot_work import WorkSnapshot, OFFER_FIELDS
+# Клиенты Google таблиц и ABCP импортируются при первом использовании, чтобы не тратить время запуска
+# на gspread, oauth2client и aiohttp там, где они не нужны (повторная проценка, процессы применения правил)
+from data_local.storage_work import Storage, STORAGES, call_storage, get_storage
 from datetime import datetime as dt
 import statistics # Для определения медианной цены
+from concurrent.futures import ProcessPoolExecutor
+
+# Результат проценки для позиций, по которым не найдено ни одного предложения
+NOT_FOUND_RESULT = 'предложение не найдено см. вкладку ошибки'
+# Результат проценки для позиций, по которым не получен ответ от ABCP
+STALE_RESULT = 'нет ответа ABCP, повтор при следующем запуске'
+
+# Минимальное количество позиций, начиная с которого правила применяются в отдельных процессах
+POOL_MIN_PRODUCTS = 500
+
+# Папка для результатов проценки частей каталога при запуске в несколько процессов
+SPOOL_DIR = 'spool'
+
+# Этапы трассировки правила и колонки листа ошибок, в которые они выводятся
+TRACE_KEYS = {
+    'supplier': 'filter_by_supplier',
+    'routes': 'filter_by_routes',
+    'storage': 'filter_by_storage',
+    'min_stock': 'filter_by_min_stock',
+    'delivery_probability': 'filter_by_delivery_probability',
+    'delivery_period': 'filter_by_delivery_period',
+    'price_deviation': 'filter_by_price_deviation',
+    'select': 'select_count_product',
+}
 
 # Задаём параметры логирования
 logger.add(FILE_NAME_LOG,
@@ -27,6 +66,38 @@ def filtered_products_by_flag(products: list[dict]):
     return filtered_products
 
 
+def prioritize_by_demand(products: list[dict], all_products: list[dict], demand: dict, budget: int = 0) -> list[dict]:
+    """
+    Формируем очередь проценки по спросу покупателей.
+    В начало очереди ставим позиции с заказами, включая не отмеченные для проценки, если у них заданы правила.
+    Позиции упорядочены по сумме продаж, при равной сумме - по большей оборачиваемости и меньшему наличию.
+    Остальные отмеченные позиции идут следом в порядке листа.
+    :param products: Отмеченные для проценки позиции из filtered_products_by_flag
+    :param all_products: Все позиции листа
+    :param demand: Спрос из WorkDemand.demand
+    :param budget: Максимальное количество позиций для запросов к ABCP за запуск. 0 - без ограничения
+    :return: Список позиций для проценки
+    """
+    queue = {}
+    for product in products + [product for product in all_products if product['id_rule']]:
+        key = demand_key(product['brand'], product['number'])
+        if key not in queue and (product['select_flag'] == '1' or key in demand):
+            queue[key] = product
+
+    def priority(item: tuple) -> tuple:
+        key, product = item
+        return (-demand[key]['revenue'], -WorkDemand.convert_number(product['turn_ratio']),
+                WorkDemand.convert_number(product['stock']))
+
+    demanded = sorted(((key, product) for key, product in queue.items() if key in demand), key=priority)
+    queue = [product for key, product in demanded] + [product for key, product in queue.items() if key not in demand]
+    logger.info(f"Позиций со спросом: {len(demanded)}, всего в очереди проценки: {len(queue)}")
+    if budget and len(queue) > budget:
+        logger.warning(f"Очередь проценки ограничена {budget} позициями, отложено {len(queue) - budget}")
+        queue = queue[:budget]
+    return queue
+
+
 def selected_rule_for_position(products: list[dict], rules: list[dict]) -> list[dict]:
     """
     Добавляем правила к каждой позиции
@@ -55,35 +126,306 @@ def selected_rule_for_position(products: list[dict], rules: list[dict]) -> list[
     return products
 
 
-def get_price_supplier(products: list[dict], own_warehouses: list) -> list[dict]:
+def get_price_supplier(
+        products: list[dict], own_warehouses: list, snapshot: WorkSnapshot = None, memo: WorkMemo = None,
+        workers: int = 1, brands: WorkBrands = None
+) -> list[dict]:
     """
     Получение цены согласно заданных правил
     :param products: Список словарей с товарами для проценки
     :param own_warehouses: Список своих складов
+    :param snapshot: Снимок, в который сохраняем полученные от ABCP предложения
+    :param memo: Сохранённые результаты правил по неизменившимся предложениям
+    :param workers: Количество процессов для применения правил
+    :param brands: Соответствия брендов ABCP. Если заданы, то позиции без предложений ищутся по бренду ABCP
     :return:
     """
     logger.debug(products)
+    from api_abcp.abcp_work import WorkABCP
+
     work_abcp = WorkABCP()
+    searches = search_keys(products, brands)
+    logger.warning(f"Ищем {len(searches)} позиций")
+
+    async def fetch_offers():
+        # Запрашиваем данные по позициям с платформы ABCP
+        offers = await work_abcp.get_prices_supplier(searches)
+        if brands is not None:
+            offers = await resolve_brands(work_abcp, brands, products, offers)
+        return offers
+
+    offers = asyncio.run(fetch_offers())
+
+    if snapshot is not None:
+        for product, result in zip(products, offers):
+            if result is not None:
+                snapshot.add(product, result)
+
+    return evaluate_products(products, offers, own_warehouses, memo, workers)
+
+
+def search_keys(products: list[dict], brands: WorkBrands = None) -> list[tuple]:
+    """
+    Бренд и номер для поиска по каждой позиции. Если заданы псевдонимы, то ищем по ним
+    :param products: Список словарей с товарами для проценки
+    :param brands: Сохранённые соответствия брендов ABCP. Используются, если псевдоним бренда не задан
+    :return: [(brand, number), ...] в порядке позиций
+    """
+    searches = []
     for product in products:
         # Выбираем номер для поиска
         number = product['alias_number'] if product['alias_number'] else product['number']
         # Выбираем бренд для поиска
         brand = product['alias_brand'] if product['alias_brand'] else product['brand']
-        logger.warning(f"Ищем позицию {brand}: {number}")
-        # Запрашиваем данные по позиции с платформы ABCP
-        result = asyncio.run(work_abcp.get_price_supplier(brand, number))
+        if brands is not None and not product['alias_brand']:
+            brand = brands.get(brand) or brand
+        searches.append((brand, number))
+    return searches
+
+
+async def resolve_brands(work_abcp, brands: WorkBrands, products: list[dict], offers: list) -> list:
+    """
+    Повторный поиск позиций, по которым ABCP не нашёл предложений, по бренду ABCP для номера позиции.
+    Найденное соответствие бренда сохраняется в brands и при следующих запусках используется сразу
+    :param work_abcp: WorkABCP
+    :param brands: Сохранённые соответствия брендов ABCP
+    :param products: Список словарей с товарами для проценки
+    :param offers: Предложения по позициям из get_prices_supplier
+    :return: Предложения по позициям с результатами повторного поиска
+    """
+    searches = search_keys(products, brands)
+    retry = [i for i, (product, result) in enumerate(zip(products, offers))
+             if result == [] and not product['alias_brand'] and not brands.is_miss(*searches[i])]
+    if not retry:
+        return offers
+    logger.info(f"Определяем бренд ABCP по {len(retry)} позициям без предложений")
+    abcp_brands = await asyncio.gather(*(work_abcp.get_brands(searches[i][1]) for i in retry))
+
+    resolved = []
+    for i, candidates in zip(retry, abcp_brands):
+        if candidates is None:
+            continue
+        abcp_brand = brands.match(products[i]['brand'], candidates)
+        if abcp_brand is None or abcp_brand == searches[i][0]:
+            brands.put_miss(*searches[i])
+        else:
+            resolved.append((i, abcp_brand))
+
+    found = 0
+    for (i, abcp_brand), result in zip(resolved, await work_abcp.get_prices_supplier(
+            [(abcp_brand, searches[i][1]) for i, abcp_brand in resolved])):
+        if result:
+            brands.put(products[i]['brand'], abcp_brand)
+            offers[i] = result
+            found += 1
+        elif result is not None:
+            brands.put_miss(*searches[i])
+    logger.info(f"Найдены предложения по бренду ABCP для {found} позиций")
+    return offers
+
+
+def evaluate_products(
+        products: list[dict], offers: list[list[dict]], own_warehouses: list, memo: WorkMemo = None,
+        workers: int = 1
+) -> list[dict]:
+    """
+    Применяем правила ко всем продуктам.
+    Если процессов больше одного и позиций не меньше POOL_MIN_PRODUCTS, то правила применяются
+    пакетами в отдельных процессах. Для небольшого количества позиций передача данных в процессы
+    дороже самой фильтрации, поэтому правила применяются в текущем процессе
+    :param products: Список продуктов с правилами, подставленными selected_rule_for_position
+    :param offers: Предложения от ABCP по каждому продукту в том же порядке.
+        None - ответ от ABCP не получен, позиция помечается устаревшей для повторной проценки
+    :param own_warehouses: Список своих складов
+    :param memo: Сохранённые результаты правил по неизменившимся предложениям
+    :param workers: Количество процессов для применения правил
+    :return: Список продуктов с результатами фильтрации в ключе 'result'
+    """
+    fetched = []
+    for product, result in zip(products, offers):
+        if result is None:
+            product['result'] = {'first_result': 0, 'id_rule': {}, 'stale': True}
+        else:
+            fetched.append((product, result))
+    if len(fetched) < len(products):
+        logger.warning(f"Нет ответа ABCP по {len(products) - len(fetched)} позициям, повторим при следующем запуске")
+
+    if workers <= 1 or len(fetched) < POOL_MIN_PRODUCTS:
+        for product, result in fetched:
+            apply_rules(result, product, own_warehouses, memo)
+        return products
 
-        logger.info(f"Количество предложений от ABCP: {len(result)}")
+    pending = []
+    for product, result in fetched:
         result = [res for res in result if str(res['distributorId']) not in own_warehouses]
-        logger.info(f"Количество предложений от ABCP без своих складов: {len(result)}")
+        hash_value = ''
+        if memo is not None:
+            hash_value = memo.make_hash(result, product)
+            memo_result = memo.get(product, hash_value)
+            if memo_result is not None:
+                product['result'] = memo_result
+                continue
+        pending.append((product, result, hash_value))
+
+    batch_size = max(1, -(-len(pending) // (workers * 4)))
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    logger.info(f"Применяем правила к {len(pending)} позициям в {workers} процессах, пакетов: {len(batches)}")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_rule_worker) as executor:
+        packed_batches = (pack_batch(batch) for batch in batches)
+        for batch, results in zip(batches, executor.map(evaluate_batch, packed_batches)):
+            for (product, _, hash_value), product_result in zip(batch, results):
+                product['result'] = product_result
+                if memo is not None:
+                    memo.put(product, hash_value)
+    return products
 
-        product['result'] = {'first_result': len(result)}
-        product['result']['id_rule'] = {}
 
+def pack_batch(batch: list[tuple]) -> tuple:
+    """
+    Готовим пакет позиций для передачи в процесс.
+    Предложения передаются кортежами значений OFFER_FIELDS, правила - один раз на весь пакет
+    :param batch: [(product, offers, hash_value), ...]
+    :return: (rules, [(product, id_rules, offers), ...])
+    """
+    rules = {}
+    packed = []
+    for product, result, _ in batch:
+        rules.update(product['id_rule'])
+        packed.append((
+            {key: product.get(key) for key in ('number', 'brand', 'price', 'history_price')},
+            list(product['id_rule']),
+            [tuple(res.get(key) for key in OFFER_FIELDS) for res in result]
+        ))
+    return rules, packed
+
+
+def init_rule_worker() -> None:
+    """Отключаем подробное логирование фильтров в процессах применения правил"""
+    logger.disable(__name__)
+
+
+def evaluate_batch(batch: tuple) -> list[dict]:
+    """
+    Применяем правила к пакету позиций в отдельном процессе
+    :param batch: Пакет из pack_batch
+    :return: Список product['result'] в порядке позиций пакета
+    """
+    rules, packed = batch
+    results = []
+    for product, id_rules, result in packed:
+        product['id_rule'] = {id_rule: rules[id_rule] for id_rule in id_rules}
+        result = [dict(zip(OFFER_FIELDS, res)) for res in result]
+        results.append(apply_rules(result, product, [])['result'])
+    return results
+
+
+def apply_rules(result: list[dict], product: dict, own_warehouses: list, memo: WorkMemo = None) -> dict:
+    """
+    Применяем все правила продукта к предложениям поставщиков
+    :param result: Список предложений от ABCP по продукту
+    :param product: Данные по продукту с правилами, подставленными selected_rule_for_position
+    :param own_warehouses: Список своих складов
+    :param memo: Сохранённые результаты правил. Если предложения, правила и цена не изменились,
+        то берём сохранённый результат без фильтрации
+    :return: Данные по продукту с добавленными результатами фильтрации в ключе 'result'
+    """
+    logger.info(f"Количество предложений от ABCP: {len(result)}")
+    result = [res for res in result if str(res['distributorId']) not in own_warehouses]
+    logger.info(f"Количество предложений от ABCP без своих складов: {len(result)}")
+
+    hash_value = ''
+    if memo is not None:
+        hash_value = memo.make_hash(result, product)
+        memo_result = memo.get(product, hash_value)
+        if memo_result is not None:
+            logger.info(f"Предложения и правила не изменились, берём сохранённый результат")
+            product['result'] = memo_result
+            return product
+
+    product['result'] = {'first_result': len(result)}
+    product['result']['id_rule'] = {}
+
+    # Правила применяются в порядке приоритета до первого найденного предложения: по остальным правилам
+    # цена не выбирается. Предложения после этапов поставщиков, маршрутов и складов сохраняются в плане
+    # позиции и используются следующими правилами с такими же параметрами этих этапов
+    product['plan'] = {}
+    try:
         for rule in product['id_rule']:
-            product['result']['id_rule'][rule] = {}
+            product['result']['id_rule'][rule] = {'trace': []}
             product = filtered_result(result, rule, product)
-    return products
+            if product['result']['id_rule'][rule].get('select_product'):
+                break
+    finally:
+        del product['plan']
+
+    if memo is not None:
+        memo.put(product, hash_value)
+    return product
+
+
+def stage_subset(product: dict, stage: tuple, result: list[dict], select) -> list[dict]:
+    """
+    Предложения после этапа фильтрации из плана позиции. Если этап с такими же параметрами
+    уже применялся к тем же предложениям по другому правилу позиции, то берём сохранённый результат
+    :param product: Данные по продукту. План позиции в ключе 'plan' создаётся в apply_rules
+    :param stage: Название этапа и его параметры
+    :param result: Предложения, к которым применяется этап
+    :param select: Функция без аргументов, возвращающая предложения после этапа
+    :return: Список предложений после этапа
+    """
+    plan = product.get('plan')
+    if plan is None:
+        return select()
+    # Входные предложения - исходный список позиции или результат предыдущего этапа из плана,
+    # поэтому они не удаляются до конца применения правил и id не повторяется
+    key = (*stage, id(result))
+    if key not in plan:
+        plan[key] = select()
+    return plan[key]
+
+
+def add_trace(
+        product: dict, id_rule: str, stage: str, count: int, supplier: str = '', storage: str = ''
+) -> None:
+    """
+    Записываем количество предложений после этапа фильтрации в трассировку правила
+    :param product: В словаре обязательно наличие ключа ['result':'{id_rule': ...}]
+    :param id_rule: Идентификатор правила
+    :param stage: Этап фильтрации из TRACE_KEYS
+    :param count: Количество предложений после этапа
+    :param supplier: Идентификатор поставщика из белого списка
+    :param storage: Идентификатор склада из белого списка
+    """
+    rule_result = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
+    rule_result.setdefault('trace', []).append([stage, supplier, storage, count])
+
+
+def render_trace(rule_result: dict) -> dict:
+    """
+    Выводим трассировку правила в текст колонок листа ошибок.
+    Количество по каждому поставщику и складу белых списков перечисляется через запятую
+    :param rule_result: Результат правила product['result']['id_rule'][id_rule]
+    :return: {колонка из TRACE_KEYS: текст}
+    """
+    if 'trace' not in rule_result:
+        # Результат сохранён в WorkMemo до появления трассировки и уже содержит текст колонок
+        return {key: rule_result.get(key, '') for key in TRACE_KEYS.values()}
+
+    values = {}
+    for stage, supplier, storage, count in rule_result['trace']:
+        key = TRACE_KEYS[stage]
+        if stage == 'supplier' and not supplier:
+            values[key] = count
+            continue
+        if stage in ('supplier', 'routes', 'storage'):
+            value = f"{supplier}: {count}" if supplier else str(count)
+        else:
+            parts = [f"п{supplier}" if supplier else "", f"с{storage}" if storage else ""]
+            parts = [part for part in parts if part]  # Убираем пустые элементы
+            value = " - ".join(parts) + (f": {count}" if parts else str(count))
+        values[key] = f"{values[key]}, {value}" if key in values else value
+    return {key: values.get(key, '') for key in TRACE_KEYS.values()}
 
 
 def pass_filter_by_supplier(result: list[dict], id_rule: str, product: dict) -> (dict, list[dict]):
@@ -95,7 +437,7 @@ def pass_filter_by_supplier(result: list[dict], id_rule: str, product: dict) ->
     :return:
     """
     logger.debug("Не учитываем правила поставщиков")
-    product['result']['id_rule'][id_rule]['filter_by_supplier'] = len(result)
+    add_trace(product, id_rule, 'supplier', len(result))
     return product, result
 
 
@@ -112,11 +454,14 @@ def filter_by_black_supplier(result: list[dict], id_rule: str, product: dict) ->
     black_list = rule_details.get('id_suppliers', '').replace(' ', '').split(',') \
         if isinstance(rule_details.get('id_suppliers'), str) else rule_details.get('id_suppliers', [])
 
-    filtered_by_supplier = [res for res in result if str(res.get('distributorId')) not in black_list]
+    filtered_by_supplier = stage_subset(
+        product, ('black_supplier', tuple(black_list)), result,
+        lambda: [res for res in result if str(res.get('distributorId')) not in black_list]
+    )
     count_matches = len(filtered_by_supplier)
     logger.debug(f"Получили {count_matches} результат(ов) после фильтрации по чёрному списку поставщиков")
 
-    product['result']['id_rule'][id_rule]['filter_by_supplier'] = count_matches
+    add_trace(product, id_rule, 'supplier', count_matches)
     return product, filtered_by_supplier
 
 
@@ -134,20 +479,16 @@ def filter_by_white_supplier(result: list[dict], id_rule: str, product: dict) ->
     logger.debug(f"Список поставщиков: {white_list}")
     for supplier in white_list:
         if supplier == "*":
-            filtered_by_white_supplier = [res for res in result if str(res['distributorId']) not in white_list]
+            filtered_by_white_supplier = stage_subset(
+                product, ('white_supplier', tuple(white_list), supplier), result,
+                lambda: [res for res in result if str(res['distributorId']) not in white_list]
+            )
         else:
-            filtered_by_white_supplier = [res for res in result if str(res['distributorId']) == supplier]
-        count_matches = len(filtered_by_white_supplier)
-
-        filter_key = 'filter_by_supplier'
-        existing_value = product['result']['id_rule'].get(id_rule, {}).get(filter_key, "")
-        new_value = f"{supplier}: {count_matches}"
-        if not product['result'].get('id_rule'):
-            product['result']['id_rule'] = {}
-        if not product['result']['id_rule'].get(id_rule):
-            product['result']['id_rule'][id_rule] = {}
-        product['result']['id_rule'][id_rule][filter_key] = \
-            f"{existing_value}, {new_value}" if existing_value else new_value
+            filtered_by_white_supplier = stage_subset(
+                product, ('white_supplier', supplier), result,
+                lambda: [res for res in result if str(res['distributorId']) == supplier]
+            )
+        add_trace(product, id_rule, 'supplier', len(filtered_by_white_supplier), supplier)
 
         logger.error(product['result']['id_rule'][id_rule])
         logger.debug(f"Получили {len(filtered_by_white_supplier)} результат(ов) по поставщику {supplier}")
@@ -180,31 +521,30 @@ def filter_by_routes(result: list[dict], id_rule: str, product: dict, supplier:
     :return: (product, filtered_by_routes)
     """
     logger.info("Фильтруем по маршрутам")
-    filtered_by_routes = []
     rule_details = product['id_rule'][id_rule]
     name_routes = rule_details.get('name_routes', [])
+    type_select_routes = bool(rule_details.get('type_select_routes', False))
+
+    def select_routes() -> list[dict]:
+        selected = []
+        for res in result:
+            supplier_description = str(res['supplierDescription'])
+            if name_routes:
+                # matches = name_routes in supplier_description
+                matches = any(route in supplier_description for route in name_routes if route)
+                check_routes = matches if type_select_routes else not matches
+            else:
+                check_routes = True
 
-    for res in result:
-        supplier_description = str(res['supplierDescription'])
-        if name_routes:
-            # matches = name_routes in supplier_description
-            matches = any(route in supplier_description for route in name_routes if route)
-            check_routes = matches if rule_details.get('type_select_routes', False) else not matches
-        else:
-            check_routes = True
-
-        if check_routes:
-            filtered_by_routes.append(res)
+            if check_routes:
+                selected.append(res)
+        return selected
 
+    filtered_by_routes = stage_subset(product, ('routes', tuple(name_routes), type_select_routes), result,
+                                      select_routes)
     count_matches = len(filtered_by_routes)
-    filter_key = 'filter_by_routes'
-    result_id_rule = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
-    existing_value = result_id_rule.get(filter_key, "")
-    new_value = f"{supplier}: {count_matches}" if supplier else str(count_matches)
-
     logger.info(f"Получили {count_matches} результат(ов) по маршрутам")
-
-    result_id_rule[filter_key] = f"{existing_value}, {new_value}" if existing_value else new_value
+    add_trace(product, id_rule, 'routes', count_matches, supplier)
     return product, filtered_by_routes
 
 
@@ -219,13 +559,8 @@ def pass_filter_by_storage(result: list[dict], id_rule: str, product: dict, supp
     """
     logger.debug(f"Пропускаем правила складов для правила {id_rule} и поставщика {supplier}")
     count_matches = len(result)
-    filter_key = 'filter_by_storage'
-    result_id_rule = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
-    existing_value = result_id_rule.get(filter_key, "")
-    new_value = f"{supplier}: {count_matches}" if supplier else str(count_matches)
-
     logger.debug(f"Получили {count_matches} результат(ов) по складам для правила {id_rule}")
-    result_id_rule[filter_key] = f"{existing_value}, {new_value}" if existing_value else new_value
+    add_trace(product, id_rule, 'storage', count_matches, supplier)
     return product, result
 
 
@@ -243,15 +578,13 @@ def filter_by_black_storage(result: list[dict], id_rule: str, product: dict, sup
     black_list = rule_details.get('supplier_storage', '').replace(' ', '').split(',') \
         if isinstance(rule_details.get('supplier_storage'), str) else rule_details.get('supplier_storage', [])
 
-    filtered_by_storage = [res for res in result if str(res['supplierCode']) not in black_list]
+    filtered_by_storage = stage_subset(
+        product, ('black_storage', tuple(black_list)), result,
+        lambda: [res for res in result if str(res['supplierCode']) not in black_list]
+    )
     count_matches = len(filtered_by_storage)
-    filter_key = 'filter_by_storage'
-    result_id_rule = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
-    existing_value = result_id_rule.get(filter_key, "")
-    new_value = f"{supplier}: {count_matches}" if supplier else str(count_matches)
-
     logger.debug(f"Получили {count_matches} результат(ов) по складам для правила {id_rule}")
-    result_id_rule[filter_key] = f"{existing_value}, {new_value}" if existing_value else new_value
+    add_trace(product, id_rule, 'storage', count_matches, supplier)
     return product, filtered_by_storage
 
 
@@ -270,17 +603,18 @@ def filter_by_white_storage(result: list[dict], id_rule: str, product: dict, sup
     filtered_by_white_storage = []
     for storage in white_list:
         if storage == "*":
-            filtered_by_white_storage = [res for res in result if str(res['supplierCode']) not in white_list]
+            filtered_by_white_storage = stage_subset(
+                product, ('white_storage', tuple(white_list), storage), result,
+                lambda: [res for res in result if str(res['supplierCode']) not in white_list]
+            )
         else:
-            filtered_by_white_storage = [res for res in result if str(res['supplierCode']) == storage]
+            filtered_by_white_storage = stage_subset(
+                product, ('white_storage', storage), result,
+                lambda: [res for res in result if str(res['supplierCode']) == storage]
+            )
         count_matches = len(filtered_by_white_storage)
-        filter_key = 'filter_by_storage'
-        result_id_rule = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
-        existing_value = result_id_rule.get(filter_key, "")
-        new_value = f"{supplier}: {count_matches}" if supplier else str(count_matches)
-
         logger.debug(f"Получили {count_matches} результат(ов) по складам для правила {id_rule}")
-        result_id_rule[filter_key] = f"{existing_value}, {new_value}" if existing_value else new_value
+        add_trace(product, id_rule, 'storage', count_matches, supplier, storage)
 
         product, filtered_by_white_storage = finalize_filters(
             filtered_by_white_storage, id_rule, product, supplier, storage
@@ -355,7 +689,8 @@ def filter_by_criteria(
     criteria_key = product_criteria_keys.get(criteria)
     res_criteria_key = res_criteria_keys.get(criteria)
     criteria_value = product['id_rule'][id_rule].get(criteria_key)
-    base_price = product.get('price', None)  # Добавляем базовую цену продукта
+    # Базовая цена продукта: медиана истории выбранных цен, а если истории нет, то цена из таблицы
+    base_price = product.get('history_price') or product.get('price', None)
 
     for res in result:
         if criteria == 'price_deviation' and criteria_value:
@@ -379,16 +714,8 @@ def filter_by_criteria(
             filtered_results.append(res)
 
     count_matches = len(filtered_results)
-    filter_key = f'filter_by_{criteria}'
-    result_id_rule = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
-    existing_value = result_id_rule.get(filter_key, "")
-
-    parts = [f"п{supplier}" if supplier else "", f"с{storage}" if storage else ""]
-    parts = [part for part in parts if part] # Убираем пустые элементы
-    new_value = " - ".join(parts) + (f": {count_matches}" if parts else str(count_matches))
-
     logger.debug(f"Получили {count_matches} результат(ов) по {criteria} для правила {id_rule}")
-    result_id_rule[filter_key] = f"{existing_value}, {new_value}" if existing_value else new_value
+    add_trace(product, id_rule, criteria, count_matches, supplier, storage)
 
     return product, filtered_results
 
@@ -434,16 +761,8 @@ def select_best_offer(
         filtered_results = []
 
     count_matches = len(filtered_results)
-    filter_key = f'select_count_product'
-    result_id_rule = product['result'].setdefault('id_rule', {}).setdefault(id_rule, {})
-    existing_value = result_id_rule.get(filter_key, "")
-
-    parts = [f"п{supplier}" if supplier else "", f"с{storage}" if storage else ""]
-    parts = [part for part in parts if part]  # Убираем пустые элементы
-    new_value = " - ".join(parts) + (f": {count_matches}" if parts else str(count_matches))
-
     logger.debug(f"Получили {count_matches} результат(ов) в выборе последней позиции по правилу {id_rule}")
-    result_id_rule[filter_key] = f"{existing_value}, {new_value}" if existing_value else new_value
+    add_trace(product, id_rule, 'select', count_matches, supplier, storage)
 
     product['result']['id_rule'][id_rule]['select_product'] = filtered_results
 
@@ -516,84 +835,148 @@ def filtered_result(result: list[dict], id_rule: str, product: dict) -> dict:
     return product
 
 
+def classify_product(product: dict, date_now: str) -> (dict or None, list[dict]):
+    """
+    Определяем строку цены и строки ошибок по результату правил одной позиции.
+    Цена берётся из первого правила, по которому найдено предложение. По каждому правилу до него
+    записывается ошибка. Если предложение не найдено ни по одному правилу, то оставляем прежнюю цену
+    с результатом NOT_FOUND_RESULT
+    :param product: Позиция листа с результатами правил в ключе 'result'
+    :param date_now: Дата проценки в формате '%d.%m.%Y'
+    :return: (строка цены или None, если у позиции нет результатов правил, список ошибок по правилам)
+    """
+    product_description = product.get('description', '')
+    date = product['updated_date'].strftime("%d.%m.%Y")
+    date = '' if date == '01.01.2024' else date
+    if product['result'].get('stale'):
+        # Ответ от ABCP не получен: оставляем прежнюю цену и дату, чтобы позиция попала в следующую проценку
+        return {
+            'number': product['number'],
+            'brand': product['brand'],
+            'description': product_description,
+            'row_product_on_sheet': product['row_product_on_sheet'],
+            'last_update_date': date,
+            'new_price': product['price'],
+            'distributor_result': STALE_RESULT,
+            'stale': True,
+        }, []
+
+    err_price_product = []
+    for id_rule_result, rule_result in product['result']['id_rule'].items():
+        if rule_result['select_product']:
+            offer = rule_result['select_product'][0]
+            # Добавляем описание товара, если его нет
+            if not product_description:
+                product_description = offer['description']
+
+            # Записываем результат в таблицу с исходными данными
+            return {
+                'number': product['number'],
+                'brand': product['brand'],
+                'description': product_description,
+                'row_product_on_sheet': product['row_product_on_sheet'],
+                'last_update_date': date_now,
+                'new_price': offer['priceIn'],
+                'distributor_result': f"{id_rule_result}; "
+                                      f"Поставщик: {offer['distributorId']}; "
+                                      f"Описание маршрута: "
+                                      f"{offer['supplierDescription']}",
+                'id_rule': id_rule_result,
+                'distributor_id': offer['distributorId'],
+                'route': offer['supplierDescription'],
+            }, err_price_product
+
+        # Записываем ошибки получения цены в таблицу с ошибками
+        err_price_product.append({
+            'number': product['number'],
+            'brand': product['brand'],
+            'description': product_description,
+            'last_update_date': date_now,
+            'id_rule': id_rule_result,
+            'first_result': product['result']['first_result'],
+            **render_trace(rule_result)
+        })
+
+    if not err_price_product:
+        return None, []
+    return {
+        'number': product['number'],
+        'brand': product['brand'],
+        'description': product_description,
+        'row_product_on_sheet': product['row_product_on_sheet'],
+        'last_update_date': date,
+        'new_price': product['price'],
+        'distributor_result': NOT_FOUND_RESULT,
+    }, err_price_product
+
+
 def sort_price_products(products: list[dict]) -> (list[dict], list[dict]):
     """
-    Сортируем результаты проценки полученные от поставщика на позиции с полученной ценой и без
-    :param products:
-    :return:
+    Сортируем результаты проценки полученные от поставщика на позиции с полученной ценой и без.
+    На каждую строку листа приходится не больше одной строки цены, на каждое правило позиции,
+    по которому не найдено предложение, - одна ошибка. Позиции, которые повторяются на листе,
+    дают ошибки один раз
+    :param products: Позиции листа с результатами правил из add_result_to_all_product
+    :return: (строки цен для set_price_products, ошибки для save_error)
     """
-    price_product = []
+    price_product = {}
     err_price_product = []
+    err_keys = set()
     date_now = dt.now().strftime("%d.%m.%Y")
 
     for product in products:
-        logger.debug(product)
-        product_description = product.get('description', '')
-        for id_rule_result in product['result']['id_rule']:
-            rule_result = product['result']['id_rule'][id_rule_result]
-            if rule_result['select_product']:
-                # Добавляем описание товара, если его нет
-                if not product_description:
-                    product_description = rule_result['select_product'][0]['description']
-
-                # Записываем результат в таблицу с исходными данными
-                price_product.append({
-                    'number': product['number'],
-                    'brand': product['brand'],
-                    'description': product_description,
-                    'row_product_on_sheet': product['row_product_on_sheet'],
-                    'last_update_date': date_now,
-                    'new_price': rule_result['select_product'][0]['priceIn'],
-                    'distributor_result': f"{id_rule_result}; "
-                                          f"Поставщик: {rule_result['select_product'][0]['distributorId']}; "
-                                          f"Описание маршрута: "
-                                          f"{rule_result['select_product'][0]['supplierDescription']}",
-                })
-                break
-            else:
-                # Записываем ошибки получения цены в таблицу с ошибками
-                err_price_product.append({
-                    'number': product['number'],
-                    'brand': product['brand'],
-                    'description': product_description,
-                    'last_update_date': date_now,
-                    'id_rule': id_rule_result,
-                    'first_result': product['result']['first_result'],
-                    'filter_by_supplier': rule_result['filter_by_supplier'],
-                    'filter_by_routes': rule_result['filter_by_routes'],
-                    'filter_by_storage': rule_result['filter_by_storage'],
-                    'filter_by_min_stock': rule_result['filter_by_min_stock'],
-                    'filter_by_delivery_probability': rule_result['filter_by_delivery_probability'],
-                    'filter_by_delivery_period': rule_result['filter_by_delivery_period'],
-                    'filter_by_price_deviation': rule_result['filter_by_price_deviation'],
-                    'select_count_product': rule_result['select_count_product']
-                })
-            if err_price_product:
-                date = product['updated_date'].strftime("%d.%m.%Y")
-                date = '' if date == '01.01.2024' else date
-
-                price_product.append({
-                    'number': product['number'],
-                    'brand': product['brand'],
-                    'description': product_description,
-                    'row_product_on_sheet': product['row_product_on_sheet'],
-                    'last_update_date': date,
-                    'new_price': product['price'],
-                    'distributor_result': 'предложение не найдено см. вкладку ошибки',
-                })
-
-    return price_product, err_price_product
-
-
-def save_error(new_error: list[dict], wk_g: WorkGoogle) -> None:
+        price_row, err_rows = classify_product(product, date_now)
+        if price_row is not None:
+            price_product[int(product['row_product_on_sheet'])] = price_row
+        key = (product['number'], product['brand'])
+        if err_rows and key not in err_keys:
+            err_keys.add(key)
+            err_price_product.extend(err_rows)
+
+    results = Counter(
+        'found' if 'id_rule' in price_row else price_row['distributor_result'] for price_row in price_product.values()
+    )
+    logger.info(f"Строк цен для записи на лист: {len(price_product)} (найдено: {results['found']}, "
+                f"не найдено: {results[NOT_FOUND_RESULT]}, нет ответа ABCP: {results[STALE_RESULT]}), "
+                f"ошибок по правилам: {len(err_price_product)}")
+    return list(price_product.values()), err_price_product
+
+
+def selected_prices(price_products: list[dict]) -> dict:
+    """
+    Определяем итоговую выбранную цену по каждой позиции из результата sort_price_products.
+    Найденное предложение имеет приоритет над строкой "предложение не найдено"
+    :param price_products: Список выбранных цен из sort_price_products
+    :return: {(number, brand): price_product}
+    """
+    prices = {}
+    for price_product in price_products:
+        key = (price_product['number'], price_product['brand'])
+        if key not in prices or prices[key]['distributor_result'] == NOT_FOUND_RESULT:
+            prices[key] = price_product
+    return prices
+
+
+def save_error(new_error: list[dict], wk_g: Storage) -> None:
     """
     Считываем ошибки за последние 7 дней и добавляем новые
-    :param wk_g: Класс WorkGoogle для работы с Google таблицей
+    :param wk_g: Хранилище позиций, правил и ошибок (Google таблица или SQLite)
     :param new_error: Список словарей продуктов с ошибками
     :return: None
     """
     logger.info(f"Считываем ошибки за последние 7 дней и добавляем новые")
     list_error, days_log = wk_g.get_error()
+    wk_g.save_new_result_on_sheet(merge_errors(list_error, days_log, new_error), 2, 4)
+
+
+def merge_errors(list_error: list[dict], days_log: int, new_error: list[dict]) -> list[dict]:
+    """
+    Оставляем сохранённые ошибки за последние days_log дней и добавляем новые
+    :param list_error: Сохранённые ошибки из get_error
+    :param days_log: Количество дней хранения ошибок
+    :param new_error: Список словарей продуктов с ошибками
+    :return: Ошибки для записи
+    """
     logger.debug(f"Кол-во ошибок на листе: {len(list_error)=}")
     # list_error = [error for error in list_error if (dt.now() - error['last_update_date']).days <= days_log]
     new_list_error = []
@@ -603,7 +986,7 @@ def save_error(new_error: list[dict], wk_g: WorkGoogle) -> None:
             new_list_error.append(error)
     logger.debug(f"Количество ошибок после фильтрации по дням: {len(new_list_error)=}")
     new_list_error.extend(new_error)
-    wk_g.save_new_result_on_sheet(new_list_error, 2, 4)
+    return new_list_error
 
 
 def add_result_to_all_product(result: list[dict], data: list[dict]) -> list[dict]:
@@ -628,31 +1011,243 @@ def add_result_to_all_product(result: list[dict], data: list[dict]) -> list[dict
     return new_list
 
 
-def main():
+def read_rules(rules_file: str = '', storage: str = 'google') -> (list[dict], list):
+    """
+    Считываем правила для повторной проценки
+    :param rules_file: CSV выгрузка страницы правил. Если не указано, то используем правила из хранилища
+    :param storage: Хранилище с текущими правилами: 'google' или 'sqlite'
+    :return: (rules, own_warehouses)
+    """
+    if rules_file:
+        from google_table.google_tb_work import WorkGoogle
+
+        with open(rules_file, encoding='utf-8', newline='') as file:
+            return WorkGoogle.parse_price_filter_rules(list(csv.reader(file)))
+    return get_storage(storage).get_price_filter_rules()
+
+
+def replay(file_name: str = '', rules_file: str = '', workers: int = 1, storage: str = 'google') -> list[dict]:
+    """
+    Повторная проценка по сохранённому снимку предложений без запросов к API ABCP.
+    Выводит разницу выбранных цен между снимком и повторной проценкой
+    :param file_name: Имя файла снимка. Если не указано, то берём последний снимок
+    :param rules_file: CSV выгрузка страницы правил с новыми правилами.
+        Если не указано, то используем текущие правила из хранилища
+    :param workers: Количество процессов для применения правил
+    :param storage: Хранилище с текущими правилами: 'google' или 'sqlite'
+    :return: Список отличий [{'number', 'brand', 'old_price', 'new_price', 'old_result', 'new_result'}, ...]
+    """
+    snapshot = WorkSnapshot().load(file_name)
+    products = snapshot.products
+    rules, own_warehouses = read_rules(rules_file, storage)
+    products = selected_rule_for_position(products, rules)
+
+    # Отключаем подробное логирование фильтров, чтобы проценка всего каталога занимала секунды
+    logger.disable(__name__)
+    try:
+        offers = [snapshot.offers(index) for index in range(len(products))]
+        evaluate_products(products, offers, own_warehouses, workers=workers)
+        # Как и при проценке, строки с одинаковыми номером и брендом получают результат последней из них
+        products = add_result_to_all_product(products, products)
+        new_price_product, _ = sort_price_products(products)
+    finally:
+        logger.enable(__name__)
+        snapshot.close()
+
+    new_prices = {price_product['row_product_on_sheet']: price_product for price_product in new_price_product}
+
+    diff = []
+    for product in products:
+        old = product['selected'] or {}
+        new = new_prices.get(product['row_product_on_sheet'], {})
+        if (old.get('new_price'), old.get('distributor_result')) != (new.get('new_price'), new.get('distributor_result')):
+            diff.append({
+                'number': product['number'],
+                'brand': product['brand'],
+                'old_price': old.get('new_price'),
+                'new_price': new.get('new_price'),
+                'old_result': old.get('distributor_result', ''),
+                'new_result': new.get('distributor_result', ''),
+            })
+
+    for item in diff:
+        print(f"{item['brand']}: {item['number']}\t{item['old_price']} -> {item['new_price']}\t"
+              f"{item['old_result']} -> {item['new_result']}")
+    print(f"Позиций в снимке: {len(products)}, изменилась выбранная цена: {len(diff)}")
+    return diff
+
+
+def explain(sku: str, file_name: str = '', rules_file: str = '', storage: str = 'google') -> list[dict]:
+    """
+    Выводим полную трассировку правил по одной позиции из сохранённого снимка предложений
+    :param sku: Номер позиции или 'бренд:номер'
+    :param file_name: Имя файла снимка. Если не указано, то берём последний снимок
+    :param rules_file: CSV выгрузка страницы правил. Если не указано, то используем правила из хранилища
+    :param storage: Хранилище с текущими правилами: 'google' или 'sqlite'
+    :return: Список позиций снимка с результатами правил в ключе 'result'
+    """
+    brand, _, number = sku.rpartition(':')
+    snapshot = WorkSnapshot().load(file_name)
+    indexes = [index for index, product in enumerate(snapshot.products)
+               if product['number'] == number and (not brand or product['brand'] == brand)]
+    if not indexes:
+        snapshot.close()
+        print(f"Позиция {sku} не найдена в снимке")
+        return []
+
+    rules, own_warehouses = read_rules(rules_file, storage)
+    products = selected_rule_for_position([snapshot.products[index] for index in indexes], rules)
+
+    logger.disable(__name__)
+    try:
+        for product, index in zip(products, indexes):
+            apply_rules(snapshot.offers(index), product, own_warehouses)
+    finally:
+        logger.enable(__name__)
+        snapshot.close()
+
+    for product in products:
+        print(f"{product['brand']}: {product['number']}\tцена в таблице: {product.get('price')}, "
+              f"базовая цена: {product.get('history_price') or product.get('price')}, "
+              f"предложений без своих складов: {product['result']['first_result']}")
+        for id_rule, rule_result in product['result']['id_rule'].items():
+            if rule_result['select_product']:
+                offer = rule_result['select_product'][0]
+                selected = (f"поставщик {offer['distributorId']}, цена {offer['priceIn']}, "
+                            f"маршрут {offer['supplierDescription']}")
+            else:
+                selected = NOT_FOUND_RESULT
+            print(f"  Правило {id_rule}: {selected}")
+            for stage, supplier, storage_code, count in rule_result['trace']:
+                print(f"    {stage:<22}{('п' + supplier) if supplier else '':<12}"
+                      f"{('с' + storage_code) if storage_code else '':<12}{count}")
+    return products
+
+
+def main(workers: int = 1, storage: str = 'google', demand: bool = False, budget: int = 0,
+         resolve: bool = False):
     """
     Основной процесс программы
+    :param workers: Количество процессов для применения правил
+    :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+    :param demand: Формировать очередь проценки по спросу из заказов покупателей
+    :param budget: Максимальное количество позиций для запросов к ABCP за запуск. 0 - без ограничения
+    :param resolve: Искать позиции без предложений по бренду ABCP
     :return:
     """
     logger.info(f"... Запуск программы")
-    # Получаем данные из Google таблицы
-    wk_g = WorkGoogle()
-    all_products = wk_g.get_products()
-    count_row = len(all_products)
-    logger.info(f"Всего позиций на листе: {count_row}")
+    asyncio.run(run_pipeline(workers, storage, demand, budget, resolve))
+    logger.info(f"... Окончание работы программы")
 
-    products = filtered_products_by_flag(all_products)
-    logger.info(f"Позиций для получения цены: {len(products)}")
-    # logger.debug(products)
 
-    # Получаем правила для проценки
-    rules, own_warehouses = wk_g.get_price_filter_rules()
-    # logger.debug(f"{own_warehouses=}")
+async def stream_products(storage: str):
+    """
+    Позиции хранилища по одной, по мере чтения. Хранилище читается в отдельном потоке.
+    Из sqlite позиции приходят по мере выборки строк, поэтому запросы к ABCP начинаются до конца чтения.
+    Google таблица читается одним запросом целиком, поэтому первая позиция приходит после чтения всего листа
+    :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+    :return: Асинхронный генератор позиций
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end = object()
+
+    def produce():
+        wk_g = get_storage(storage)
+        try:
+            for product in wk_g.iter_products():
+                loop.call_soon_threadsafe(queue.put_nowait, product)
+            loop.call_soon_threadsafe(queue.put_nowait, end)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            if hasattr(wk_g, 'close'):
+                wk_g.close()
+
+    reader = loop.run_in_executor(None, produce)
+    while (product := await queue.get()) is not end:
+        if isinstance(product, Exception):
+            raise product
+        yield product
+    await reader
+
+
+async def run_pipeline(
+        workers: int = 1, storage: str = 'google', demand: bool = False, budget: int = 0, resolve: bool = False
+) -> None:
+    """
+    Проценка с наложением этапов друг на друга:
+    - правила и ошибки читаются одновременно с позициями, у каждого чтения своё подключение к хранилищу;
+    - запросы к ABCP по отмеченным позициям отправляются по мере чтения позиций, не дожидаясь всего листа
+      (только для sqlite: Google таблица читается целиком одним запросом; при проценке по спросу очередь
+      формируется по всем позициям, поэтому запросы начинаются после чтения);
+    - цены и ошибки записываются одновременно (в sqlite по очереди: запись блокирует всю базу)
+    :param workers: Количество процессов для применения правил
+    :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+    :param demand: Формировать очередь проценки по спросу из заказов покупателей
+    :param budget: Максимальное количество позиций для запросов к ABCP за запуск. 0 - без ограничения
+    :param resolve: Искать позиции без предложений по бренду ABCP
+    """
+    from api_abcp.abcp_work import WorkABCP
+
+    # Получаем правила для проценки и сохранённые ошибки, пока читаются позиции
+    rules_task = asyncio.ensure_future(asyncio.to_thread(call_storage, storage, 'get_price_filter_rules'))
+    errors_task = asyncio.ensure_future(asyncio.to_thread(call_storage, storage, 'get_error'))
+
+    work_abcp = WorkABCP()
+    brands = WorkBrands() if resolve else None
+    all_products, products = [], []
+    try:
+        if demand:
+            all_products = await asyncio.to_thread(call_storage, storage, 'get_products')
+            # Загружаем новые заказы покупателей и ставим позиции с наибольшим спросом в начало очереди
+            work_demand = WorkDemand()
+            await work_demand.sync()
+            products = prioritize_by_demand(filtered_products_by_flag(all_products), all_products,
+                                            work_demand.demand(), budget)
+            work_demand.close()
+            logger.info(f"Позиций для получения цены: {len(products)}")
+            offers = await work_abcp.get_prices_supplier(search_keys(products, brands))
+        else:
+            async def flagged_searches():
+                async for product in stream_products(storage):
+                    all_products.append(product)
+                    if filtered_products_by_flag([product]) and (not budget or len(products) < budget):
+                        products.append(product)
+                        yield search_keys([product], brands)[0]
+                logger.info(f"Всего позиций на листе: {len(all_products)}, для получения цены: {len(products)}")
+
+            offers = await work_abcp.get_prices_supplier_stream(flagged_searches())
+        if brands is not None:
+            offers = await resolve_brands(work_abcp, brands, products, offers)
+        rules, own_warehouses = await rules_task
+    except BaseException:
+        rules_task.cancel()
+        errors_task.cancel()
+        raise
+    finally:
+        if brands is not None:
+            brands.close()
 
     # Подставляем правила для отфильтрованных позиций
     products = selected_rule_for_position(products, rules)
 
-    # Получаем цену поставщика согласно правил
-    products = get_price_supplier(products, own_warehouses)
+    # Добавляем базовую цену из истории выбранных цен для проверки отклонения цены
+    history = WorkHistory()
+    products = history.add_baselines(products)
+
+    # Применяем правила и сохраняем полученные предложения в снимок
+    snapshot = WorkSnapshot()
+    for product, result in zip(products, offers):
+        if result is not None:
+            snapshot.add(product, result)
+    memo = WorkMemo()
+    products = evaluate_products(products, offers, own_warehouses, memo, workers)
+    memo.close()
+
+    # Записываем выбранные предложения в историю цен
+    history.add_results(products)
+    history.close()
 
     # Добавляем результат проценки ко всем дублям позиций в исходной таблице
     products = add_result_to_all_product(products, all_products)
@@ -662,14 +1257,194 @@ def main():
     logger.debug(f"{new_price_product=}")
     logger.debug(f"{err_price_product=}")
 
-    # Записываем полученные цены
-    wk_g.set_price_products(new_price_product, count_row, name_column=['G', 'H', 'O', 'E'])
+    # Записываем цены и ошибки по количеству выбранных позиций на каждом этапе.
+    # В Google таблицу одновременно, в sqlite по очереди: вторая запись ждала бы снятия блокировки базы
+    list_error, days_log = await errors_task
+    writes = (
+        ('set_price_products', new_price_product, len(all_products), ['G', 'H', 'O', 'E']),
+        ('save_new_result_on_sheet', merge_errors(list_error, days_log, err_price_product), 2, 4),
+    )
+    if storage == 'sqlite':
+        for method, *args in writes:
+            await asyncio.to_thread(call_storage, storage, method, *args)
+    else:
+        await asyncio.gather(*(asyncio.to_thread(call_storage, storage, method, *args) for method, *args in writes))
+    prices = selected_prices(new_price_product)
+    snapshot.save(own_warehouses, prices)
+    WorkPriceIndex().update(prices)
+
+
+def shard_of(product: dict, shards: int) -> int:
+    """
+    Номер части каталога для позиции. Не зависит от порядка позиций на листе и от запуска,
+    поэтому позиция всегда попадает в одну и ту же часть при одинаковом количестве частей
+    :param product: Обязательны ключи 'number' и 'brand'
+    :param shards: Количество частей
+    :return: Номер части от 0 до shards - 1
+    """
+    key = f"{product['number']}\t{product['brand']}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') % shards
 
-    # Записываем в Google таблицу данные с ошибками по количеству выбранных позиций на каждом этапе
+
+def spool_file(shard: int, shards: int) -> str:
+    """Файл результатов части каталога"""
+    return os.path.join(SPOOL_DIR, f"shard-{shard}-of-{shards}.json")
+
+
+def run_shard(shard: int, shards: int, workers: int = 1, storage: str = 'google') -> int:
+    """
+    Проценка одной части каталога. Результаты записываются в SPOOL_DIR и переносятся в хранилище merge_shards
+    :param shard: Номер части от 0 до shards - 1
+    :param shards: Количество частей
+    :param workers: Количество процессов для применения правил
+    :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+    :return: Количество процененных позиций
+    """
+    logger.info(f"... Запуск проценки части {shard + 1} из {shards}")
+    wk_g = get_storage(storage)
+    # Как и при проценке без частей, строки с одинаковыми номером и брендом получают результат последней из них
+    products = {}
+    for product in filtered_products_by_flag(wk_g.get_products()):
+        if shard_of(product, shards) == shard:
+            products[(product['number'], product['brand'])] = product
+    products = list(products.values())
+    logger.info(f"Позиций для получения цены в части {shard + 1} из {shards}: {len(products)}")
+
+    rules, own_warehouses = wk_g.get_price_filter_rules()
+    products = selected_rule_for_position(products, rules)
+    history = WorkHistory()
+    products = history.add_baselines(products)
+    history.close()
+
+    # Позиция всегда попадает в одну и ту же часть, поэтому у каждой части свои сохранённые результаты
+    memo = WorkMemo(f"result_memo_{shard}_of_{shards}.db")
+    products = get_price_supplier(products, own_warehouses, memo=memo, workers=workers)
+    memo.close()
+
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    file_name = spool_file(shard, shards)
+    with open(f"{file_name}.tmp", 'w', encoding='utf-8') as file:
+        json.dump([{'number': product['number'], 'brand': product['brand'], 'result': product['result']}
+                   for product in products], file, ensure_ascii=False, default=str)
+    os.replace(f"{file_name}.tmp", file_name)
+    logger.info(f"... Окончание проценки части {shard + 1} из {shards}")
+    return len(products)
+
+
+def merge_shards(shards: int, storage: str = 'google') -> bool:
+    """
+    Объединяем результаты всех частей каталога и одним запросом записываем цены и ошибки в хранилище
+    :param shards: Количество частей
+    :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+    :return: True, если результаты всех частей получены и записаны
+    """
+    missing = [shard for shard in range(shards) if not os.path.exists(spool_file(shard, shards))]
+    if missing:
+        logger.error(f"Нет результатов частей {', '.join(str(shard + 1) for shard in missing)} из {shards}, "
+                     f"цены не записаны")
+        return False
+    results = []
+    for shard in range(shards):
+        with open(spool_file(shard, shards), encoding='utf-8') as file:
+            results.extend(json.load(file))
+    logger.info(f"Объединяем результаты {shards} частей: {len(results)} позиций")
+
+    history = WorkHistory()
+    history.add_results(results)
+    history.close()
+
+    wk_g = get_storage(storage)
+    all_products = wk_g.get_products()
+    products = add_result_to_all_product(results, all_products)
+    new_price_product, err_price_product = sort_price_products(products)
+    wk_g.set_price_products(new_price_product, len(all_products), name_column=['G', 'H', 'O', 'E'])
     save_error(err_price_product, wk_g)
+    WorkPriceIndex().update(selected_prices(new_price_product))
 
-    logger.info(f"... Окончание работы программы")
+    for shard in range(shards):
+        os.remove(spool_file(shard, shards))
+    return True
+
+
+def run_shards(shards: int, workers: int = 1, storage: str = 'google') -> bool:
+    """
+    Проценка каталога в shards локальных процессах с последующим объединением результатов
+    :param shards: Количество частей
+    :param workers: Количество процессов для применения правил в каждой части
+    :param storage: Хранилище позиций, правил и ошибок: 'google' или 'sqlite'
+    :return: True, если все части проценены и результаты записаны
+    """
+    for shard in range(shards):
+        if os.path.exists(spool_file(shard, shards)):
+            os.remove(spool_file(shard, shards))
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--shard', f"{shard}/{shards}",
+                          '--workers', str(workers), '--storage', storage])
+        for shard in range(shards)
+    ]
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        logger.error(f"Проценка частей {', '.join(str(shard + 1) for shard in failed)} из {shards} "
+                     f"завершилась с ошибкой, цены не записаны")
+        return False
+    return merge_shards(shards, storage)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Получение цены от поставщика по API ABCP')
+    parser.add_argument('--replay', nargs='?', const='', metavar='FILE',
+                        help='Повторная проценка по снимку предложений без запросов к ABCP (по умолчанию последний)')
+    parser.add_argument('--rules-file', default='', metavar='CSV',
+                        help='CSV выгрузка страницы правил для повторной проценки')
+    parser.add_argument('--explain', default='', metavar='SKU',
+                        help='Вывести трассировку правил по позиции (номер или бренд:номер) из снимка --replay '
+                             'или последнего снимка')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='Количество процессов для применения правил (по умолчанию 1)')
+    parser.add_argument('--storage', choices=STORAGES, default='google',
+                        help='Хранилище позиций, правил и ошибок (по умолчанию google)')
+    parser.add_argument('--import-products', default='', metavar='CSV',
+                        help='Загрузить позиции из CSV выгрузки первой страницы таблицы в локальную базу')
+    parser.add_argument('--import-rules', default='', metavar='CSV',
+                        help='Загрузить правила из CSV выгрузки второй страницы таблицы в локальную базу')
+    parser.add_argument('--days-log', default='', metavar='N',
+                        help='Срок хранения ошибок в днях (ячейка C1 третьей страницы), загружается с --import-rules')
+    parser.add_argument('--demand', action='store_true',
+                        help='Проценивать в первую очередь позиции с заказами покупателей')
+    parser.add_argument('--budget', type=int, default=0, metavar='N',
+                        help='Максимальное количество позиций для запросов к ABCP за запуск (по умолчанию без ограничения)')
+    parser.add_argument('--shards', type=int, default=0, metavar='N',
+                        help='Проценить каталог в N локальных процессах и объединить результаты')
+    parser.add_argument('--shard', default='', metavar='I/N',
+                        help='Проценить часть I (с нуля) из N и записать результаты в папку spool')
+    parser.add_argument('--merge', type=int, default=0, metavar='N',
+                        help='Объединить результаты N частей из папки spool и записать их в хранилище')
+    parser.add_argument('--resolve-brands', action='store_true',
+                        help='Искать позиции без предложений по бренду ABCP и запоминать соответствие брендов')
+    args = parser.parse_args()
+
+    if args.import_products or args.import_rules:
+        from data_local.sqlite_work import WorkSQLite
+
+        work_sqlite = WorkSQLite()
+        for import_file, import_method in (
+                (args.import_products, work_sqlite.import_products),
+                (args.import_rules, lambda rows: work_sqlite.import_rules(rows, args.days_log)),
+        ):
+            if import_file:
+                with open(import_file, encoding='utf-8', newline='') as file:
+                    import_method(list(csv.reader(file)))
+        work_sqlite.close()
+    elif args.shard:
+        shard, shards = map(int, args.shard.split('/'))
+        run_shard(shard, shards, args.workers, args.storage)
+    elif args.merge:
+        merge_shards(args.merge, args.storage)
+    elif args.shards:
+        run_shards(args.shards, args.workers, args.storage)
+    elif args.explain:
+        explain(args.explain, args.replay or '', args.rules_file, args.storage)
+    elif args.replay is not None:
+        replay(args.replay, args.rules_file, args.workers, args.storage)
+    else:
+        main(args.workers, args.storage, args.demand, args.budget, args.resolve_brands)
@@ -0,0 +1,109 @@
+# Author Loik Andrey mail: loikand@mail.ru
+import argparse
+import asyncio
+
+from aiohttp import web
+from loguru import logger
+
+from data_local.price_index_work import WorkPriceIndex, PRICE_INDEX_FILE
+
+# Порт сервиса цен (только локальные подключения)
+PRICE_API_PORT: int = 8086
+
+# Как часто проверяем, записан ли новый индекс цен, сек
+PRICE_INDEX_CHECK_INTERVAL: float = 5.0
+
+# Максимальное количество позиций в одном запросе
+PRICE_API_BULK_LIMIT: int = 10000
+
+
+class PriceAPI:
+    """
+    Сервис выбранных цен для других систем (витрина, закупки) вместо чтения Google таблицы.
+    Отвечает из индекса в памяти. Когда проценка записывает новый индекс, он считывается в отдельном
+    потоке и подменяет текущий одним присваиванием, поэтому запросы всегда видят целый индекс
+    """
+    def __init__(self, file_name: str = PRICE_INDEX_FILE):
+        self.file_name = file_name
+        self.index = WorkPriceIndex(file_name)
+
+    async def reload(self) -> bool:
+        """
+        Считываем индекс, если файл изменился
+        :return: True, если индекс заменён
+        """
+        index = WorkPriceIndex(self.file_name)
+        index.mtime = self.index.mtime
+        if not await asyncio.to_thread(index.load):
+            return False
+        self.index = index
+        logger.info(f"Загружен индекс цен от {index.created}: {len(index.prices)} позиций")
+        return True
+
+    async def watch(self) -> None:
+        """Проверяем файл индекса каждые PRICE_INDEX_CHECK_INTERVAL секунд"""
+        while True:
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке индекса цен: {e}")
+            await asyncio.sleep(PRICE_INDEX_CHECK_INTERVAL)
+
+    async def handle_price(self, request: web.Request) -> web.Response:
+        """GET /price?brand=...&number=... - цена по одной позиции, 404 если цены нет"""
+        brand, number = request.query.get('brand', ''), request.query.get('number', '')
+        if not brand or not number:
+            return web.json_response({'error': 'нужны параметры brand и number'}, status=400)
+        price = self.index.get(brand, number)
+        if price is None:
+            return web.json_response({'error': 'цена не найдена'}, status=404)
+        return web.json_response(price)
+
+    async def handle_prices(self, request: web.Request) -> web.Response:
+        """
+        POST /prices с телом [{"brand": ..., "number": ...}, ...] - цены по списку позиций
+        в том же порядке, null для позиций без цены
+        """
+        try:
+            items = await request.json()
+            if not isinstance(items, list) or len(items) > PRICE_API_BULK_LIMIT:
+                raise ValueError
+            index = self.index
+            prices = [index.get(item['brand'], item['number']) for item in items]
+        except (ValueError, KeyError, TypeError):
+            return web.json_response(
+                {'error': f'ожидается список до {PRICE_API_BULK_LIMIT} объектов с ключами brand и number'}, status=400
+            )
+        return web.json_response(prices)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Дата и размер текущего индекса"""
+        return web.json_response({'created': self.index.created, 'prices': len(self.index.prices)})
+
+
+async def serve(port: int = PRICE_API_PORT, file_name: str = PRICE_INDEX_FILE) -> None:
+    """Запуск сервиса цен на 127.0.0.1:port"""
+    api = PriceAPI(file_name)
+    await api.reload()
+    app = web.Application()
+    app.router.add_get('/price', api.handle_price)
+    app.router.add_post('/prices', api.handle_prices)
+    app.router.add_get('/health', api.handle_health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    logger.info(f"... Сервис цен запущен: http://127.0.0.1:{port}/price")
+    try:
+        await api.watch()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Сервис выбранных цен по бренду и номеру')
+    parser.add_argument('--port', type=int, default=PRICE_API_PORT,
+                        help=f'Порт сервиса (по умолчанию {PRICE_API_PORT})')
+    parser.add_argument('--index', default=PRICE_INDEX_FILE, metavar='FILE',
+                        help=f'Файл индекса цен (по умолчанию {PRICE_INDEX_FILE})')
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.index))
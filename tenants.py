@@ -0,0 +1,219 @@
+# Author Loik Andrey mail: loikand@mail.ru
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import certifi
+from loguru import logger
+
+import config
+from api_abcp.abcp_fair import FairShare
+from api_abcp.abcp_work import WorkABCP
+from data_local.history_work import WorkHistory, HISTORY_DB
+from data_local.memo_work import WorkMemo, MEMO_DB
+from data_local.price_index_work import WorkPriceIndex, PRICE_INDEX_FILE
+from data_local.snapshot_work import WorkSnapshot, SNAPSHOT_DIR
+from data_local.storage_work import get_storage
+from main import (add_result_to_all_product, evaluate_products, filtered_products_by_flag, save_error,
+                  search_keys, selected_prices, selected_rule_for_position, sort_price_products)
+
+# Папка с историей цен, сохранёнными результатами, снимками и индексом цен магазинов
+TENANTS_DIR: str = 'tenants'
+
+# Файл с показателями последней проценки магазинов
+TENANT_METRICS_FILE: str = 'tenant_metrics.json'
+
+# Общий лимит одновременных запросов к ABCP и соединений всех магазинов
+TENANT_CONNECTIONS: int = 64
+
+
+def load_tenants() -> list[dict]:
+    """
+    Магазины из config.TENANTS. Незаданные параметры подключения берутся из AUTH_API и AUTH_GOOGLE
+    :return: [{'name', 'AUTH_API', 'KEY_WORKBOOK', 'storage', 'storage_file', 'offer_group'}, ...]
+    """
+    tenants = []
+    for tenant in getattr(config, 'TENANTS', []):
+        tenants.append({
+            'name': tenant['name'],
+            'AUTH_API': tenant.get('AUTH_API') or config.AUTH_API,
+            'KEY_WORKBOOK': tenant.get('KEY_WORKBOOK', ''),
+            'storage': tenant.get('storage', 'google'),
+            'storage_file': tenant.get('storage_file', ''),
+            'offer_group': tenant.get('offer_group', ''),
+        })
+    if len({tenant['name'] for tenant in tenants}) != len(tenants):
+        raise ValueError("Имена магазинов в config.TENANTS должны быть уникальными")
+    return tenants
+
+
+class TenantRun:
+    """
+    Проценка одного магазина в общем цикле событий.
+    Обращения к хранилищу и базам SQLite магазина выполняются в отдельном потоке магазина
+    """
+    def __init__(self, tenant: dict, workers: int = 1):
+        self.tenant = tenant
+        self.name = tenant['name']
+        self.workers = workers
+        self.path = os.path.join(TENANTS_DIR, self.name)
+        self.work_abcp = WorkABCP(tenant['AUTH_API'])
+        self.work_abcp.tenant = self.name
+        self.metrics = {'products': 0, 'searches': 0, 'offer_cache_hits': 0, 'stale': 0,
+                        'price_rows': 0, 'error_rows': 0, 'seconds': 0.0, 'error': ''}
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"tenant-{self.name}")
+        self._wk_g = None
+        self._history = None
+
+    async def _run(self, func, *args):
+        """Выполняем блокирующую функцию в потоке магазина"""
+        return await asyncio.get_running_loop().run_in_executor(self._thread, func, *args)
+
+    def storage_location(self) -> str:
+        """Файл базы для хранилища sqlite или id Google таблицы для google. Пустая строка - из общих настроек"""
+        return self.tenant['storage_file'] if self.tenant['storage'] == 'sqlite' else self.tenant['KEY_WORKBOOK']
+
+    def load(self) -> (list[dict], list[dict], list):
+        """
+        Считываем позиции и правила магазина, подставляем правила и базовую цену из истории
+        :return: (all_products, products, own_warehouses)
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._wk_g = get_storage(self.tenant['storage'], self.storage_location())
+        all_products = self._wk_g.get_products()
+        products = filtered_products_by_flag(all_products)
+        rules, own_warehouses = self._wk_g.get_price_filter_rules()
+        products = selected_rule_for_position(products, rules)
+        self._history = WorkHistory(os.path.join(self.path, HISTORY_DB))
+        products = self._history.add_baselines(products)
+        logger.info(f"[{self.name}] Всего позиций на листе: {len(all_products)}, для получения цены: {len(products)}")
+        return all_products, products, own_warehouses
+
+    def finish(self, all_products: list[dict], products: list[dict], offers: list, own_warehouses: list) -> None:
+        """Применяем правила, записываем историю, снимок, цены и ошибки магазина"""
+        snapshot = WorkSnapshot(os.path.join(self.path, SNAPSHOT_DIR))
+        for product, result in zip(products, offers):
+            if result is not None:
+                snapshot.add(product, result)
+        memo = WorkMemo(os.path.join(self.path, MEMO_DB))
+        products = evaluate_products(products, offers, own_warehouses, memo, self.workers)
+        memo.close()
+        self._history.add_results(products)
+
+        products = add_result_to_all_product(products, all_products)
+        new_price_product, err_price_product = sort_price_products(products)
+        prices = selected_prices(new_price_product)
+        snapshot.save(own_warehouses, prices)
+        WorkPriceIndex(os.path.join(self.path, PRICE_INDEX_FILE)).update(prices)
+        self._wk_g.set_price_products(new_price_product, len(all_products), name_column=['G', 'H', 'O', 'E'])
+        save_error(err_price_product, self._wk_g)
+        self.metrics.update(price_rows=len(new_price_product), error_rows=len(err_price_product))
+
+    def close(self) -> None:
+        """Закрываем историю цен и хранилище магазина, в том числе после ошибки между load и finish"""
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+        if hasattr(self._wk_g, 'close'):
+            self._wk_g.close()
+        self._wk_g = None
+
+
+class TenantRunner:
+    """
+    Проценка нескольких магазинов в одном процессе.
+    Магазины используют общий цикл событий, общую сессию aiohttp и общий лимит запросов с распределением
+    по кругу (FairShare). Предложения по одинаковым бренду и номеру запрашиваются один раз для магазинов
+    с одинаковой 'offer_group', то есть работающих с одной сетью поставщиков
+    """
+    def __init__(self, tenants: list[dict], workers: int = 1, connections: int = TENANT_CONNECTIONS):
+        self.runs = [TenantRun(tenant, workers) for tenant in tenants]
+        self.connections = connections
+        self.fair_share = FairShare(connections)
+        self.offer_cache = {}
+
+    async def fetch_offers(self, run: TenantRun, products: list[dict]) -> list[list[dict] or None]:
+        """
+        Предложения ABCP по позициям магазина. Позиции, уже запрошенные магазином той же группы,
+        не запрашиваются повторно, а ожидают ответ на первый запрос
+        :return: Список предложений в порядке позиций. None - ответ ABCP не получен
+        """
+        loop = asyncio.get_running_loop()
+        group = run.tenant['offer_group']
+        futures, missing = [], {}
+        for search in search_keys(products):
+            key = (group, *search) if group else (run.name, *search)
+            if key in self.offer_cache:
+                run.metrics['offer_cache_hits'] += 1
+            elif key not in missing:
+                self.offer_cache[key] = missing[key] = loop.create_future()
+            futures.append(self.offer_cache[key])
+        run.metrics['searches'] = len(missing)
+
+        offers = [None] * len(missing)
+        try:
+            offers = await run.work_abcp.get_prices_supplier([key[1:] for key in missing])
+        finally:
+            for (key, future), result in zip(missing.items(), offers):
+                if result is None:
+                    # Повторный запрос другим магазином группы возможен, если этот не получил ответ
+                    self.offer_cache.pop(key, None)
+                future.set_result(result)
+        return list(await asyncio.gather(*futures))
+
+    async def price_tenant(self, run: TenantRun) -> None:
+        """Проценка одного магазина. Ошибка одного магазина не прерывает проценку остальных"""
+        start = time.monotonic()
+        logger.info(f"[{run.name}] ... Запуск проценки")
+        try:
+            all_products, products, own_warehouses = await run._run(run.load)
+            run.metrics['products'] = len(products)
+            offers = await self.fetch_offers(run, products)
+            run.metrics['stale'] = sum(result is None for result in offers)
+            await run._run(run.finish, all_products, products, offers, own_warehouses)
+        except Exception as e:
+            logger.exception(f"[{run.name}] Ошибка проценки: {e}")
+            run.metrics['error'] = str(e)
+        finally:
+            # Подключения SQLite закрываются в том же потоке магазина, в котором открыты
+            await run._run(run.close)
+            limiter = run.work_abcp.limiter.stats()
+            run.metrics.update(seconds=round(time.monotonic() - start, 1), abcp_limit=limiter['limit'],
+                               abcp_p95=round(limiter['p95'], 3), abcp_breaker=run.work_abcp.breaker.state,
+                               fair_share_requests=self.fair_share.granted[run.name])
+            run._thread.shutdown(wait=False)
+            logger.info(f"[{run.name}] ... Окончание проценки: {run.metrics}")
+
+    async def run(self) -> dict:
+        """
+        Проценка всех магазинов
+        :return: {имя магазина: показатели проценки}
+        """
+        connector = aiohttp.TCPConnector(limit=self.connections,
+                                         ssl=ssl.create_default_context(cafile=certifi.where()))
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for run in self.runs:
+                run.work_abcp.use_session(session)
+                run.work_abcp.fair_share = self.fair_share
+            await asyncio.gather(*(self.price_tenant(run) for run in self.runs))
+
+        metrics = {run.name: run.metrics for run in self.runs}
+        with open(TENANT_METRICS_FILE, 'w', encoding='utf-8') as file:
+            json.dump(metrics, file, ensure_ascii=False, indent=2)
+        return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Получение цены от поставщика по API ABCP для нескольких магазинов')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='Количество процессов для применения правил каждого магазина (по умолчанию 1)')
+    parser.add_argument('--connections', type=int, default=TENANT_CONNECTIONS, metavar='N',
+                        help=f'Общий лимит одновременных запросов к ABCP (по умолчанию {TENANT_CONNECTIONS})')
+    args = parser.parse_args()
+    asyncio.run(TenantRunner(load_tenants(), args.workers, args.connections).run())
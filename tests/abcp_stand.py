@@ -0,0 +1,226 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import re
+import socket
+import ssl
+import threading
+import time
+
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+# Окно, за которое считается количество запросов поиска для ограничения rate_limit, сек
+RATE_WINDOW: float = 0.1
+
+# Самоподписанный сертификат и ключ локального сервера (клиент подключается без проверки сертификата)
+STAND_CERT: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'abcp_stand.pem')
+
+
+class StandResolver(AbstractResolver):
+    """Направляем запросы к любому хосту ABCP на локальный сервер"""
+    def __init__(self, port: int):
+        self.port = port
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> list[dict]:
+        return [{'hostname': host, 'host': '127.0.0.1', 'port': self.port,
+                 'family': socket.AF_INET, 'proto': 0, 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self) -> None:
+        pass
+
+
+def stand_session(port: int, limit: int = 100) -> aiohttp.ClientSession:
+    """Сессия aiohttp, которая отправляет запросы к ABCP на локальный сервер с портом port"""
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=limit, resolver=StandResolver(port), ssl=False
+    ))
+
+
+def route_to_stand(port: int):
+    """
+    Замена BaseAbcp._get_new_session: все сессии aioabcpapi отправляют запросы на локальный сервер.
+    Нужна, когда WorkABCP создаётся внутри проверяемого кода (main, run_shard) и use_session недоступен
+    """
+    async def _get_new_session(base) -> aiohttp.ClientSession:
+        return stand_session(port)
+    return _get_new_session
+
+
+class AbcpStand:
+    """
+    Локальный сервер вместо API ABCP для тестов.
+    Отвечает на search/articles предложениями, которые зависят только от бренда и номера.
+    Если задан rate_limit, то запросы сверх rate_limit в секунду (за любое окно RATE_WINDOW сек)
+    получают ошибку в формате ABCP.
+    На cp/orders/online отвечает результатом по каждой позиции: позиции из locked заблокированы заданное
+    количество раз, позиции из failed не отправляются, остальные оформляются в заказ.
+    cp/order/statusHistory возвращает историю статусов позиции, для позиций из ordered_elsewhere
+    при повторном запросе история дополняется, как если бы позицию оформили из панели управления.
+    cp/orders отдаёт заказы orders страницами, страницы с началом из orders_page_errors отвечают ошибкой
+    """
+    def __init__(self, rate_limit: int = 0, latency: float = 0.0):
+        """
+        :param rate_limit: Допустимое количество запросов поиска в секунду. 0 - без ограничения
+        :param latency: Время ответа на запрос поиска, сек
+        """
+        self.rate_limit = rate_limit
+        self.latency = latency
+        self.port = 0
+        self.accepted = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._recent = deque()
+        self._runner = None
+        # Заказы: позиция -> сколько раз ответить блокировкой, позиции с ошибкой, оформленные другим способом
+        self.locked = {}
+        self.failed = set()
+        self.ordered_elsewhere = set()
+        self.history_errors = set()
+        self.order_requests = []
+        self.ordered = []
+        self._history_requests = {}
+        # Заказы покупателей для cp/orders и страницы (skip), которые отвечают ошибкой
+        self.orders = []
+        self.orders_page_errors = set()
+
+    async def __aenter__(self) -> 'AbcpStand':
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.stop()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/search/articles', self.handle_articles)
+        app.router.add_post('/cp/orders/online', self.handle_online_order)
+        app.router.add_get('/cp/order/statusHistory', self.handle_status_history)
+        app.router.add_get('/cp/orders', self.handle_orders)
+        return app
+
+    async def start(self) -> None:
+        """Запускаем сервер на свободном порту 127.0.0.1"""
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(STAND_CERT)
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0, ssl_context=context)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    @contextlib.contextmanager
+    def running(self):
+        """
+        Сервер в отдельном потоке со своим циклом событий.
+        Для проверки кода, который сам запускает asyncio.run, например main
+        """
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+        try:
+            yield self
+        finally:
+            asyncio.run_coroutine_threadsafe(self.stop(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def session(self, limit: int = 100) -> aiohttp.ClientSession:
+        """Сессия aiohttp, которая отправляет запросы к ABCP на этот сервер"""
+        return stand_session(self.port, limit)
+
+    @staticmethod
+    def error(status: int, code: int, message: str) -> web.Response:
+        """Ошибка в формате ABCP"""
+        return web.json_response({'errorCode': code, 'errorMessage': message}, status=status)
+
+    def _throttle(self) -> bool:
+        """Запрос превышает rate_limit за последнее окно RATE_WINDOW"""
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > RATE_WINDOW:
+            self._recent.popleft()
+        if len(self._recent) >= self.rate_limit * RATE_WINDOW:
+            return True
+        self._recent.append(now)
+        return False
+
+    async def handle_articles(self, request: web.Request) -> web.Response:
+        if self._throttle():
+            self.throttled += 1
+            return self.error(429, 429, 'Превышено допустимое количество запросов')
+        self.accepted += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return web.json_response(self.offers(request.query.get('brand', ''), request.query.get('number', '')))
+
+    async def handle_online_order(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        fields = (re.fullmatch(r'positions\[(\d+)\]\[id\]', key) for key in form.keys())
+        ids = [form[match.group(0)] for match in sorted(filter(None, fields), key=lambda match: int(match.group(1)))]
+        self.order_requests.append(ids)
+
+        positions = []
+        for position_id in ids:
+            if self.locked.get(position_id):
+                self.locked[position_id] -= 1
+                positions.append({'id': position_id, 'status': 0, 'errorCode': 200,
+                                  'errorMessage': 'Позиция заблокирована на 5 мин.'})
+            elif position_id in self.failed:
+                positions.append({'id': position_id, 'status': 0, 'errorCode': 301,
+                                  'errorMessage': 'Товар отсутствует у поставщика'})
+            else:
+                self.ordered.append(position_id)
+                positions.append({'id': position_id, 'status': 1, 'errorCode': 0, 'errorMessage': ''})
+        return web.json_response({'status': 1, 'positions': positions})
+
+    async def handle_status_history(self, request: web.Request) -> web.Response:
+        position_id = request.query.get('positionId', '')
+        if position_id in self.history_errors:
+            return self.error(500, 1, 'Внутренняя ошибка')
+        self._history_requests[position_id] = self._history_requests.get(position_id, 0) + 1
+        history = [{'positionId': position_id, 'statusId': 1, 'statusName': 'Новый'}]
+        if position_id in self.ordered_elsewhere and self._history_requests[position_id] > 1:
+            history.append({'positionId': position_id, 'statusId': 2, 'statusName': 'Заказано'})
+        return web.json_response(history)
+
+    async def handle_orders(self, request: web.Request) -> web.Response:
+        skip, limit = int(request.query.get('skip', 0)), int(request.query.get('limit', 100))
+        if skip in self.orders_page_errors:
+            return self.error(500, 1, 'Внутренняя ошибка')
+        return web.json_response({'count': len(self.orders), 'items': self.orders[skip:skip + limit]})
+
+    @staticmethod
+    def offers(brand: str, number: str) -> list[dict]:
+        """Предложения поставщиков по позиции. Одинаковые для одинаковых бренда и номера"""
+        seed = hashlib.blake2b(f"{brand}\t{number}".encode('utf-8'), digest_size=8).digest()
+        return [
+            {
+                'brand': brand,
+                'number': number,
+                'description': f"Деталь {number}",
+                'priceIn': 80 + seed[i] % 40 + seed[i + 3] / 100,
+                'deliveryPeriod': seed[i + 1] % 10,
+                'availability': seed[i + 2] % 20,
+                'deliveryProbability': 90,
+                'distributorId': i + 1,
+                'supplierCode': str(10 * (i + 1)),
+                'supplierDescription': ('Москва', 'Питер', 'Склад')[i],
+            }
+            for i in range(3)
+        ]
@@ -0,0 +1,21 @@
+import os
+import sys
+import tempfile
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# Параметры подключения для тестов вместо config.py с рабочими доступами.
+# Хост ABCP не используется: запросы направляются на локальный сервер AbcpStand
+TEST_CONFIG = {
+    'AUTH_API': {'HOST_API': 'id12345.public.api.abcp.ru', 'USER_API': 'api@id12345',
+                 'PASSWORD_API': '0123456789abcdef0123456789abcdef'},
+    'AUTH_GOOGLE': {'GOOGLE_CLIENT_ID': '', 'GOOGLE_CLIENT_SECRET': '', 'KEY_WORKBOOK': ''},
+    'FILE_NAME_LOG': os.path.join(tempfile.gettempdir(), 'get_supplier_price_tests.log'),
+}
+
+config = types.ModuleType('config')
+config.__dict__.update(TEST_CONFIG)
+sys.modules['config'] = config
@@ -0,0 +1,20 @@
+"""
+Одна часть проценки в отдельном процессе, как при запуске main.py --shard:
+python shard_worker.py <порт AbcpStand> <часть> <количество частей>
+Запускается в папке с storage.db, запросы к ABCP направляются на локальный сервер
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import conftest  # noqa: F401 - config для тестов вместо config.py с рабочими доступами
+from abcp_stand import route_to_stand
+from aioabcpapi.base import BaseAbcp
+
+import main
+
+if __name__ == '__main__':
+    port, shard, shards = (int(value) for value in sys.argv[1:4])
+    BaseAbcp._get_new_session = route_to_stand(port)
+    main.run_shard(shard, shards, storage='sqlite')
@@ -0,0 +1,49 @@
+import asyncio
+
+from abcp_stand import AbcpStand
+from api_abcp.abcp_breaker import CircuitBreaker
+from api_abcp.abcp_limiter import AdaptiveLimiter
+from api_abcp.abcp_work import WorkABCP
+
+# Сервер отвечает за LATENCY сек и допускает RATE_LIMIT запросов в секунду,
+# то есть без ошибок выдерживает RATE_LIMIT * LATENCY одновременных запросов
+RATE_LIMIT = 250
+LATENCY = 0.02
+SEARCHES = 800
+
+
+async def price_against_stand() -> (WorkABCP, AbcpStand, list):
+    async with AbcpStand(rate_limit=RATE_LIMIT, latency=LATENCY) as stand:
+        work_abcp = WorkABCP()
+        work_abcp.limiter = AdaptiveLimiter(start_limit=1, window_size=10)
+        # Проверяем лимит, а не автомат защиты и дублирующие запросы
+        work_abcp.breaker = CircuitBreaker(failure_threshold=SEARCHES)
+        work_abcp.hedge = False
+        async with stand.session() as session:
+            work_abcp.use_session(session)
+            offers = await work_abcp.get_prices_supplier([('MANN', f"W{i}") for i in range(SEARCHES)])
+    return work_abcp, stand, offers
+
+
+def test_limit_follows_throttling():
+    work_abcp, stand, offers = asyncio.run(price_against_stand())
+    history = work_abcp.limiter.history
+
+    increases = [(old, new) for (_, old, _), (_, new, reason) in zip(history, history[1:]) if reason.startswith('p95')]
+    decreases = [(old, new) for (_, old, _), (_, new, reason) in zip(history, history[1:]) if reason == 'error']
+
+    # Лимит растёт на один запрос за окно без ошибок
+    assert len(increases) >= 3
+    assert all(new == old + 1 for old, new in increases)
+
+    # Ошибка сервера о превышении количества запросов уменьшает лимит вдвое
+    assert stand.throttled > 0
+    assert decreases
+    assert all(new == max(1, old // 2) for old, new in decreases)
+
+    # Лимит держится около допустимого количества одновременных запросов, большая часть запросов проходит
+    allowed = RATE_LIMIT * LATENCY
+    assert max(limit for _, limit, _ in history) <= 2 * allowed
+    assert stand.max_in_flight <= 2 * allowed
+    assert stand.throttled < 0.1 * SEARCHES
+    assert sum(result is not None for result in offers) == stand.accepted
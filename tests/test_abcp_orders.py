@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from abcp_stand import AbcpStand
+from api_abcp import abcp_work
+from api_abcp.abcp_work import WorkABCP
+
+
+@pytest.fixture(autouse=True)
+def short_delays(monkeypatch):
+    monkeypatch.setattr(abcp_work, 'ORDER_LOCK_DELAY', 0.05)
+    monkeypatch.setattr(abcp_work, 'ORDER_MIN_INTERVAL', 0.01)
+
+
+def send_orders(positions: list[dict], **stand_params) -> (AbcpStand, list):
+    async def run() -> (AbcpStand, list):
+        async with AbcpStand() as stand:
+            for key, value in stand_params.items():
+                setattr(stand, key, value)
+            work_abcp = WorkABCP()
+            async with stand.session() as session:
+                work_abcp.use_session(session)
+                results = await work_abcp.send_orders_by_distributor(positions)
+        return stand, results
+    return asyncio.run(run())
+
+
+def test_results_follow_each_position():
+    # Два поставщика, у первого больше ORDER_BATCH_SIZE позиций и два набора параметров заказа
+    positions = [
+        {'id': str(100 + i), 'distributorId': 1 if i % 3 else 2,
+         'order_params': {'comment': 'срочно'} if i % 5 == 0 else {}}
+        for i in range(30)
+    ]
+    stand, results = send_orders(positions, failed={'104', '117'})
+
+    assert [result['id'] for result in results] == [position['id'] for position in positions]
+    assert {result['id'] for result in results if result['status'] == 'error'} == {'104', '117'}
+    assert all(result['status'] == 'ok' for result in results if result['id'] not in ('104', '117'))
+    assert all(len(ids) <= abcp_work.ORDER_BATCH_SIZE for ids in stand.order_requests)
+    assert sorted(stand.ordered) == sorted(position['id'] for position in positions if position['id'] not in ('104', '117'))
+
+
+def test_only_locked_positions_are_resent():
+    positions = [{'id': str(200 + i), 'distributorId': 7} for i in range(5)]
+    stand, results = send_orders(
+        positions, locked={'201': 1, '202': 1, '203': 1}, failed={'204'}, ordered_elsewhere={'202'},
+        history_errors={'203'}
+    )
+
+    # Повторно отправляется только заблокированная позиция, статус которой не изменился
+    assert stand.order_requests == [['200', '201', '202', '203', '204'], ['201']]
+    assert stand.ordered == ['200', '201']
+    assert [result['status'] for result in results] == ['ok', 'ok', 'locked', 'locked', 'error']
+    assert 'статус позиции изменился' in results[2]['errorMessage']
+    assert 'не удалось проверить статус' in results[3]['errorMessage']
+
+
+def test_position_locked_after_retries():
+    positions = [{'id': '300', 'distributorId': 7}, {'id': '301', 'distributorId': 7}]
+    stand, results = send_orders(positions, locked={'301': 5})
+
+    assert stand.order_requests == [['300', '301']] + [['301']] * abcp_work.ORDER_LOCK_RETRIES
+    assert [result['status'] for result in results] == ['ok', 'locked']
+    assert results[1]['errorMessage'] == 'Позиция заблокирована на 5 мин.'
+
+
+def sync_orders(tmp_path, monkeypatch, page_errors: set) -> (WorkABCP, list, bool):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(abcp_work, 'ORDERS_PAGE_SIZE', 10)
+    monkeypatch.setattr(abcp_work, 'ORDERS_PAGE_RETRIES', 0)
+
+    async def run() -> (WorkABCP, list, bool):
+        async with AbcpStand() as stand:
+            stand.orders = [{'number': str(i), 'dateUpdated': f"2026-10-{10 + i // 10:02} 10:00:00"} for i in range(25)]
+            stand.orders_page_errors = page_errors
+            work_abcp = WorkABCP()
+            async with stand.session() as session:
+                work_abcp.use_session(session)
+                orders = [order async for order in work_abcp.iter_orders_by_status(1, '2026-10-01 00:00:00')]
+                return work_abcp, orders, session.closed
+    return asyncio.run(run())
+
+
+def test_orders_sync_complete(tmp_path, monkeypatch):
+    work_abcp, orders, closed = sync_orders(tmp_path, monkeypatch, set())
+
+    assert sorted(int(order['number']) for order in orders) == list(range(25))
+    assert work_abcp.orders_complete
+    assert WorkABCP.get_orders_sync_mark('1') == '2026-10-12 10:00:00'
+    # Общая сессия, переданная через use_session, не закрывается
+    assert not closed
+
+
+def test_orders_sync_reports_missing_pages(tmp_path, monkeypatch):
+    work_abcp, orders, closed = sync_orders(tmp_path, monkeypatch, {10})
+
+    assert len(orders) == 15
+    assert not work_abcp.orders_complete
+    assert WorkABCP.get_orders_sync_mark('1') == ''
+    assert not closed
+
+
+def test_orders_sync_first_page_error_is_not_empty_list(tmp_path, monkeypatch):
+    work_abcp, orders, closed = sync_orders(tmp_path, monkeypatch, {0})
+
+    assert orders == []
+    assert not work_abcp.orders_complete
+    assert WorkABCP.get_orders_sync_mark('1') == ''
+    assert not closed
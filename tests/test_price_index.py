@@ -0,0 +1,27 @@
+from data_local.price_index_work import WorkPriceIndex
+
+
+def price_row(number: str, distributor_id=None, **extra) -> dict:
+    row = {'number': number, 'brand': 'MANN', 'new_price': 100.0, 'distributor_result': '',
+           'distributor_id': distributor_id, 'route': 'Москва' if distributor_id else None,
+           'id_rule': '1' if distributor_id else None}
+    return {**row, **extra}
+
+
+def test_rejected_prices_leave_index(tmp_path):
+    file_name = str(tmp_path / 'price_index.json')
+    WorkPriceIndex(file_name).update({
+        ('W1', 'MANN'): price_row('W1', 1), ('W2', 'MANN'): price_row('W2', 2), ('W3', 'MANN'): price_row('W3', 3),
+    })
+
+    # W1 найден снова, по W2 предложение не найдено, по W3 нет ответа ABCP
+    count = WorkPriceIndex(file_name).update({
+        ('W1', 'MANN'): price_row('W1', 4), ('W2', 'MANN'): price_row('W2'), ('W3', 'MANN'): price_row('W3', stale=True),
+    })
+
+    index = WorkPriceIndex(file_name)
+    assert index.load()
+    assert count == 1
+    assert index.get('mann', 'W-1')['distributor_id'] == 4
+    assert index.get('MANN', 'W2') is None
+    assert index.get('MANN', 'W3')['distributor_id'] == 3
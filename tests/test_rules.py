@@ -0,0 +1,127 @@
+import copy
+import random
+
+import pytest
+
+import main
+from data_local.sqlite_work import WorkSQLite
+from main import (NOT_FOUND_RESULT, STALE_RESULT, add_result_to_all_product, apply_rules, evaluate_products,
+                  filtered_result, selected_rule_for_position, sort_price_products)
+from test_shards import RULES
+
+# Правила с общими этапами: 5 и 3 отбирают одинаковые маршруты, 6 и 2 - одинаковых поставщиков,
+# 7 и 1 - одинаковых поставщиков, маршруты и склады и отличаются только остатком и выбором
+OVERLAPPING_RULES = RULES + [
+    ['5', '', '', '', '', 'черный список', 'Склад', '', '', '15', '', '', 'цена', '15'],
+    ['6', '', '', 'черный список', '3', '', '', '', '', '', '', '5', 'медиана', ''],
+    ['7', '', '', 'белый список', '1, 2, *', 'белый список', 'Москва, Питер', 'черный список', '12', '5', '',
+     '', 'срок', ''],
+]
+
+PRODUCT_RULES = ['4, 5, 3', '4, 6, 2', '1, 7, 5, 3', '5, 6, 7, 1, 2, 3', '4', '7, 1']
+
+
+@pytest.fixture(scope='module')
+def rules(tmp_path_factory) -> list[dict]:
+    storage = WorkSQLite(str(tmp_path_factory.mktemp('rules') / 'storage.db'))
+    storage.import_rules(OVERLAPPING_RULES)
+    rules, _ = storage.get_price_filter_rules()
+    storage.close()
+    return rules
+
+
+def make_offers(seed: int) -> list[dict]:
+    """Предложения четырёх поставщиков с разными маршрутами, складами, остатками и ценами"""
+    generator = random.Random(seed)
+    return [
+        {
+            'brand': 'MANN', 'number': f"W{seed}", 'description': f"Деталь W{seed}",
+            'distributorId': generator.choice([1, 2, 3, 4]),
+            'supplierCode': generator.choice(['10', '12', '20']),
+            'supplierDescription': generator.choice(['Москва', 'Питер', 'Склад', 'Москва Склад']),
+            'availability': generator.randint(0, 20),
+            'deliveryPeriod': generator.randint(0, 12),
+            'deliveryProbability': generator.choice([0, 40, 60, 95]),
+            'priceIn': round(generator.uniform(70, 130), 2),
+        }
+        for _ in range(generator.randint(0, 12))
+    ]
+
+
+def make_product(seed: int, id_rule: str, rules: list[dict], row: int = 0) -> dict:
+    product = {'number': f"W{seed}", 'brand': 'MANN', 'description': '', 'price': 100.0, 'id_rule': id_rule,
+               'row_product_on_sheet': row or seed + 2}
+    return selected_rule_for_position([product], rules)[0]
+
+
+def chain_per_rule(offers: list[dict], product: dict) -> dict:
+    """
+    Результат прежней цепочки: каждое правило фильтруется отдельно, без общих этапов.
+    Оставляем правила до первого найденного предложения, так как цена берётся по нему
+    """
+    product = copy.deepcopy(product)
+    product['result'] = {'first_result': len(offers), 'id_rule': {}}
+    for rule in product['id_rule']:
+        product['result']['id_rule'][rule] = {'trace': []}
+        product = filtered_result(offers, rule, product)
+    rule_results = {}
+    for rule, rule_result in product['result']['id_rule'].items():
+        rule_results[rule] = rule_result
+        if rule_result.get('select_product'):
+            break
+    product['result']['id_rule'] = rule_results
+    return product['result']
+
+
+def test_shared_stages_match_per_rule_chain(rules, monkeypatch):
+    shared = []
+    stage_subset = main.stage_subset
+
+    def counting_stage_subset(product, stage, result, select):
+        shared.append((*stage, id(result)) in product.get('plan', {}))
+        return stage_subset(product, stage, result, select)
+
+    monkeypatch.setattr(main, 'stage_subset', counting_stage_subset)
+    for seed in range(100):
+        offers = make_offers(seed)
+        for id_rule in PRODUCT_RULES:
+            product = make_product(seed, id_rule, rules)
+            expected = chain_per_rule(offers, product)
+            assert apply_rules(offers, product, [])['result'] == expected, (seed, id_rule)
+            assert 'plan' not in product
+
+    # Этапы действительно берутся из плана позиции, а не считаются заново
+    assert any(shared) and not all(shared)
+
+
+def test_one_price_row_per_sheet_row(rules):
+    offer = {'brand': 'MANN', 'number': '', 'description': 'Фильтр', 'distributorId': 1, 'supplierCode': '10',
+             'supplierDescription': 'Москва', 'availability': 10, 'deliveryPeriod': 2, 'deliveryProbability': 95,
+             'priceIn': 95.0}
+    # Найдено, не найдено, нет ответа ABCP и дубли позиции на листе с разными правилами
+    products = [
+        make_product(1, '4, 3', rules),
+        make_product(2, '4', rules),
+        make_product(3, '4, 3', rules),
+        make_product(4, '4', rules, row=10),
+        make_product(4, '3', rules, row=11),
+    ]
+    offers = [[offer], [offer], None, [offer], [offer]]
+    products = evaluate_products(products, offers, [])
+    sheet = [{key: product[key] for key in ('number', 'brand', 'description', 'price', 'row_product_on_sheet')}
+             for product in products]
+    for row in sheet:
+        row['updated_date'] = main.dt(2024, 5, 1)
+    products = add_result_to_all_product(products, sheet)
+
+    price_rows, err_rows = sort_price_products(products)
+
+    rows = {row['row_product_on_sheet']: row for row in price_rows}
+    assert len(price_rows) == len(rows) == len(sheet)
+    assert rows[3]['id_rule'] == '3' and rows[3]['new_price'] == 95.0
+    assert rows[4]['distributor_result'] == NOT_FOUND_RESULT and rows[4]['new_price'] == 100.0
+    assert rows[5]['distributor_result'] == STALE_RESULT and rows[5]['last_update_date'] == '01.05.2024'
+    # Дубли получают результат последней строки, то есть по правилу 3
+    assert rows[10]['id_rule'] == rows[11]['id_rule'] == '3'
+    # Ошибки только по правилу 4 до найденного правила, у дублей W4 ошибок нет, как и у последней строки
+    assert sorted((row['number'], row['id_rule']) for row in err_rows) == [('W1', '4'), ('W2', '4')]
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+from aioabcpapi.base import BaseAbcp
+
+import main
+from abcp_stand import AbcpStand, route_to_stand
+from data_local.sqlite_work import WorkSQLite, PRODUCT_COLUMNS
+
+SHARDS = 3
+PRODUCTS = 120
+SHARD_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shard_worker.py')
+
+# Вторая страница таблицы: склады в строке 2, правила с 7-й строки
+RULES = [
+    [''] * 14,
+    ['', '', '', '', '5'] + [''] * 9,
+    [''] * 14,
+    [''] * 14,
+    [''] * 14,
+    [''] * 14,
+    ['1', '', '', 'белый список', '1, 2, *', 'белый список', 'Москва, Питер', 'черный список', '12', '2', '',
+     '10', 'цена', ''],
+    ['2', '', '', 'черный список', '3', '', '', 'белый список', '10, *', '', '50', '', 'срок', ''],
+    ['3', '', '', '', '', 'черный список', 'Склад', '', '', '', '', '', 'медиана', ''],
+    ['4', '', '', 'белый список', '99', '', '', '', '', '', '', '', 'цена', ''],
+]
+
+
+def sheet_products() -> list[list[str]]:
+    """
+    Первая страница таблицы. Каждая седьмая позиция повторяется в конце листа с другими правилами,
+    каждая десятая не отмечена для проценки. Правило 4 не находит предложений
+    """
+    products = [
+        {'number': f"W{i}", 'brand': 'MANN', 'price': '100', 'stock': '1', 'turn_ratio': '1',
+         'select_flag': '0' if i % 10 == 0 else '1', 'id_rule': '4' if i % 9 == 0 else '3' if i % 4 == 0 else '1, 2'}
+        for i in range(PRODUCTS)
+    ]
+    products += [
+        {**product, 'select_flag': '1', 'id_rule': '1, 2' if product['id_rule'] == '3' else '3'}
+        for product in products[::7]
+    ]
+    return [PRODUCT_COLUMNS] + [[product.get(column, '') for column in PRODUCT_COLUMNS] for product in products]
+
+
+def prepare_storage(path) -> None:
+    os.makedirs(path)
+    storage = WorkSQLite(os.path.join(path, 'storage.db'))
+    storage.import_products(sheet_products())
+    storage.import_rules(RULES)
+    storage.close()
+
+
+def dump_storage(path) -> dict:
+    with sqlite3.connect(os.path.join(path, 'storage.db')) as conn:
+        return {table: conn.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall() for table in ('products', 'errors')}
+
+
+def test_shards_match_single_run(tmp_path, monkeypatch):
+    single, sharded = tmp_path / 'single', tmp_path / 'sharded'
+    prepare_storage(single)
+    prepare_storage(sharded)
+
+    with AbcpStand().running() as stand:
+        monkeypatch.setattr(BaseAbcp, '_get_new_session', route_to_stand(stand.port))
+        monkeypatch.chdir(single)
+        main.main(storage='sqlite')
+
+        # Части проценяются в отдельных процессах одновременно, затем результаты объединяются
+        monkeypatch.chdir(sharded)
+        workers = [
+            subprocess.Popen([sys.executable, SHARD_WORKER, str(stand.port), str(shard), str(SHARDS)],
+                             cwd=sharded, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for shard in range(SHARDS)
+        ]
+        for worker in workers:
+            _, stderr = worker.communicate(timeout=120)
+            assert worker.returncode == 0, stderr.decode('utf-8', 'replace')[-2000:]
+        assert main.merge_shards(SHARDS, storage='sqlite')
+
+    single_tables, sharded_tables = dump_storage(single), dump_storage(sharded)
+    assert any(row[-2] for row in single_tables['products'])
+    assert single_tables['errors']
+    assert sharded_tables == single_tables
@@ -0,0 +1,41 @@
+import sqlite3
+import threading
+import time
+
+from data_local.sqlite_work import WorkSQLite, DAYS_LOG_DEFAULT, ERROR_COLUMNS
+
+
+def test_write_waits_for_lock(tmp_path):
+    file_name = str(tmp_path / 'storage.db')
+    WorkSQLite(file_name).close()
+
+    # Другое подключение держит блокировку записи, запись ошибок дожидается её снятия
+    other = sqlite3.connect(file_name, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    release = threading.Timer(0.5, other.commit)
+    release.start()
+    started = time.monotonic()
+    storage = WorkSQLite(file_name)
+    storage.save_new_result_on_sheet([{column: 'x' for column in ERROR_COLUMNS}], 2, 4)
+    waited = time.monotonic() - started
+    release.join()
+    other.close()
+
+    assert waited >= 0.4
+    assert storage._conn.execute("SELECT COUNT(*) FROM errors").fetchone() == (1,)
+    storage.close()
+
+
+def test_days_log_imported_with_rules(tmp_path):
+    rules = [[''] * 14, ['', '', '10', '', '5'] + [''] * 9, ['', '', '3'] + [''] * 11, [''] * 14, [''] * 14, [''] * 14,
+             ['1', '', '', '', '', '', '', '', '', '', '', '', 'цена', '']]
+    storage = WorkSQLite(str(tmp_path / 'storage.db'))
+    assert storage.get_error()[1] == DAYS_LOG_DEFAULT
+
+    storage.import_rules(rules, 14)
+    assert storage.get_error()[1] == 14
+
+    # Повторная загрузка правил без срока хранения не сбрасывает загруженный ранее
+    storage.import_rules(rules)
+    assert storage.get_error()[1] == 14
+    storage.close()
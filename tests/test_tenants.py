@@ -0,0 +1,65 @@
+import asyncio
+
+import tenants
+from abcp_stand import AbcpStand
+from data_local.history_work import WorkHistory
+from data_local.sqlite_work import WorkSQLite
+from tenants import TenantRunner
+from test_shards import RULES, sheet_products
+
+
+def sqlite_tenant(tmp_path) -> dict:
+    """Магазин с локальным хранилищем, у которого задан и id Google таблицы"""
+    storage = WorkSQLite(str(tmp_path / 'shop.db'))
+    storage.import_products(sheet_products())
+    storage.import_rules(RULES)
+    storage.close()
+    return {'name': 'shop', 'AUTH_API': tenants.config.AUTH_API, 'KEY_WORKBOOK': 'workbook-id',
+            'storage': 'sqlite', 'storage_file': str(tmp_path / 'shop.db'), 'offer_group': ''}
+
+
+def price_tenants(tenant_list: list[dict]) -> TenantRunner:
+    async def run() -> TenantRunner:
+        async with AbcpStand() as stand:
+            runner = TenantRunner(tenant_list)
+            async with stand.session() as session:
+                for tenant_run in runner.runs:
+                    tenant_run.work_abcp.use_session(session)
+                    tenant_run.work_abcp.fair_share = runner.fair_share
+                await asyncio.gather(*(runner.price_tenant(tenant_run) for tenant_run in runner.runs))
+        return runner
+    return asyncio.run(run())
+
+
+def test_sqlite_tenant_uses_storage_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tenant = sqlite_tenant(tmp_path)
+
+    runner = price_tenants([tenant])
+
+    assert runner.runs[0].storage_location() == tenant['storage_file']
+    assert runner.runs[0].metrics['error'] == ''
+    assert runner.runs[0].metrics['price_rows'] > 0
+
+
+def test_history_closed_after_failed_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tenant = sqlite_tenant(tmp_path)
+    closed = []
+
+    class TrackedHistory(WorkHistory):
+        def close(self) -> None:
+            closed.append(self)
+            super().close()
+
+    def evaluate_products(*args, **kwargs):
+        raise RuntimeError('ошибка применения правил')
+
+    monkeypatch.setattr(tenants, 'WorkHistory', TrackedHistory)
+    monkeypatch.setattr(tenants, 'evaluate_products', evaluate_products)
+
+    runner = price_tenants([tenant])
+
+    assert runner.runs[0].metrics['error'] == 'ошибка применения правил'
+    assert len(closed) == 1
+    assert runner.runs[0]._history is None and runner.runs[0]._wk_g is None